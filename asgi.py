@@ -0,0 +1,321 @@
+"""ASGI entry point for the async serving mode: ``uvicorn asgi:app``.
+
+Connections are owned by the event loop, so thousands of idle or slow
+clients need no threads. Database work runs on two bounded thread pools:
+reads (GET/HEAD) and writes (everything else), so a slow write or a
+busy_timeout wait cannot starve cheap lookups. The hot paths are native
+coroutines: NFC lookups answered from the tag cache never leave the event
+loop, and the attendance stream is fanned out on the loop. All other
+routes run the Flask app on the matching pool.
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+READ_THREADS = int(os.environ.get("ASYNC_READ_THREADS", "16"))
+WRITE_THREADS = int(os.environ.get("ASYNC_WRITE_THREADS", "4"))
+MAX_PENDING = int(os.environ.get("ASYNC_MAX_PENDING", "1000"))
+
+# Every pool thread checks out one connection; keep that many warm.
+main.pool.max_idle = max(main.pool.max_idle, READ_THREADS + WRITE_THREADS)
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, PUT, DELETE, OPTIONS"),
+    (b"access-control-allow-headers", b"Content-Type, Authorization, Accept, If-None-Match, Idempotency-Key"),
+    (b"access-control-expose-headers", b"ETag, Idempotent-Replayed"),
+]
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """Thread pool with a cap on queued jobs; excess callers get Overloaded."""
+
+    def __init__(self, name, threads, max_pending):
+        self.name = name
+        self.threads = threads
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+        self._pending = 0
+        self._rejected = 0
+
+    async def run(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            raise Overloaded(f"{self.name} pool is saturated")
+        return await self.run_admitted(fn, *args)
+
+    async def run_admitted(self, fn, *args):
+        """Run follow-up work for a request that was already admitted."""
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "threads": self.threads,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "rejected": self._rejected,
+        }
+
+
+read_pool = BoundedExecutor("db-read", READ_THREADS, MAX_PENDING)
+write_pool = BoundedExecutor("db-write", WRITE_THREADS, MAX_PENDING)
+
+
+class AsyncEventFeed:
+    """Wakes coroutines on the event loop whenever the broker publishes."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._loop = None
+        self._waiters = set()
+        self._subscribers = 0
+
+    def _attach(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.broker.add_listener(lambda: loop.call_soon_threadsafe(self._wake))
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def subscribe(self, last_event_id, match):
+        self._attach()
+        cursor = self.broker.events_since(0)[1] if last_event_id is None else last_event_id
+        self._subscribers += 1
+        waiter = None
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                waiter = self._loop.create_future()
+                self._waiters.add(waiter)
+                events, last_id = self.broker.events_since(cursor)
+                if not events:
+                    try:
+                        await asyncio.wait_for(waiter, self.broker.heartbeat)
+                    except asyncio.TimeoutError:
+                        self._waiters.discard(waiter)
+                        yield ": keepalive\n\n"
+                        continue
+                    events, last_id = self.broker.events_since(cursor)
+                self._waiters.discard(waiter)
+                cursor = max(cursor, last_id)
+                for event_id, event_type, data in events:
+                    if match(data):
+                        yield self.broker.format(event_id, event_type, data)
+        finally:
+            self._subscribers -= 1
+            if waiter is not None:
+                self._waiters.discard(waiter)
+
+    def stats(self):
+        return {"subscribers": self._subscribers, "waiters": len(self._waiters)}
+
+
+attendance_feed = AsyncEventFeed(main.attendance_events)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "REMOTE_ADDR": client[0],
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def start_wsgi(environ):
+    """Run the Flask app up to its first body chunk (called on a pool thread)."""
+    state = {}
+
+    def start_response(status, headers, exc_info=None):
+        state["status"] = int(status.split(" ", 1)[0])
+        state["headers"] = headers
+
+    result = main.app(environ, start_response)
+    iterator = iter(result)
+    first = next(iterator, None)
+    return state, first, iterator, result
+
+
+def close_wsgi(result):
+    if hasattr(result, "close"):
+        result.close()
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers + CORS_HEADERS})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def serve_wsgi(scope, receive, send):
+    body = await read_body(receive)
+    executor = read_pool if scope["method"] in ("GET", "HEAD", "OPTIONS") else write_pool
+    state, first, iterator, result = await executor.run(start_wsgi, build_environ(scope, body))
+    try:
+        headers = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in state["headers"]]
+        await send({"type": "http.response.start", "status": state["status"], "headers": headers})
+        chunk = first
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await executor.run_admitted(next, iterator, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await executor.run_admitted(close_wsgi, result)
+
+
+async def nfc_user(tag_id, send):
+    if main.tag_cache.needs_resync():
+        await read_pool.run(main.resync_tag_cache)
+    user = main.tag_cache.get(tag_id)
+    if user is None:
+        def lookup():
+            with main.pool.connection() as conn:
+                return main.lookup_tag_user(conn, tag_id)
+
+        user_id, user = await read_pool.run(lookup)
+        if user_id is None:
+            return await send_json(send, 404, {"status": "error", "message": "Tag not found"})
+        if user is None:
+            return await send_json(send, 404, {"status": "error", "message": "User not found"})
+    await send_json(send, 200, user)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def attendance_stream(scope, receive, send):
+    args = urllib.parse.parse_qs(scope["query_string"].decode("latin1"))
+    date = args.get("date", [None])[0]
+    user_id = args.get("user_id", [None])[0]
+    headers = {k.decode("latin1").lower(): v.decode("latin1") for k, v in scope["headers"]}
+    last_event_id = headers.get("last-event-id") or args.get("last_event_id", [None])[0]
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return await send_json(send, 400, {"status": "error", "message": "Invalid Last-Event-ID"})
+
+    def match(event):
+        return (not date or event["date"] == date) and (not user_id or event["user_id"] == user_id)
+
+    await read_pool.run(main.attendance_tail.start)
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ] + CORS_HEADERS})
+
+    async def pump():
+        async for chunk in attendance_feed.subscribe(last_event_id, match):
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+
+    # Servers drop sends to a closed connection without raising, so the
+    # stream only ends when the client's disconnect is seen on receive().
+    tasks = {asyncio.ensure_future(pump()), asyncio.ensure_future(wait_for_disconnect(receive))}
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        task.result()
+
+
+NFC_USER_PATH = re.compile(r"^/nfc/([^/]+)/user$")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            main.start_background_jobs()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.get_running_loop().run_in_executor(None, main.shutdown)
+            read_pool.shutdown()
+            write_pool.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    try:
+        if method == "GET":
+            match = NFC_USER_PATH.match(path)
+            if match:
+                return await nfc_user(match.group(1), send)
+            if path == "/attendance/stream":
+                return await attendance_stream(scope, receive, send)
+            if path == "/stats/executors":
+                return await send_json(send, 200, {"read": read_pool.stats(), "write": write_pool.stats(),
+                                                   "stream": attendance_feed.stats()})
+        await serve_wsgi(scope, receive, send)
+    except Overloaded as e:
+        await send_json(send, 503, {"status": "error", "message": str(e)})
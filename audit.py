@@ -0,0 +1,310 @@
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def insert_audit_logs(conn, rows):
+    conn.executemany("INSERT INTO audit_logs (action, table_name, details, timestamp) VALUES (?, ?, ?, ?)", rows)
+
+
+# Audit rows are stamped when they are buffered and get their id when a
+# worker flushes them, so ids follow timestamps only to within ``skew``
+# seconds (flush interval plus writer delay, across every worker). These
+# bounds turn a timestamp into an id range that is safe under that disorder:
+# a row stamped more than ``skew`` before another was inserted before it.
+
+def _shift(timestamp, seconds):
+    return (datetime.datetime.fromisoformat(timestamp) + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def lower_id_bound(conn, since, skew):
+    """Lowest id a row stamped at or after ``since`` can have, or None if unbounded."""
+    row = conn.execute("SELECT id FROM audit_logs WHERE timestamp < ? ORDER BY timestamp DESC LIMIT 1",
+                       (_shift(since, -skew),)).fetchone()
+    return row[0] + 1 if row else None
+
+
+def upper_id_bound(conn, until, skew):
+    """Highest id a row stamped before ``until`` can have, or None if unbounded."""
+    row = conn.execute("SELECT id FROM audit_logs WHERE timestamp >= ? ORDER BY timestamp LIMIT 1",
+                       (_shift(until, skew),)).fetchone()
+    return row[0] - 1 if row else None
+
+
+class AuditBuffer:
+    """In-memory ring buffer of audit rows flushed in batches off the request path.
+
+    ``append`` only touches memory. A background thread flushes the buffer
+    every ``flush_interval`` seconds, or as soon as ``flush_size`` rows are
+    waiting, with one ``executemany`` submitted to the group-commit writer.
+    When the buffer holds ``capacity`` rows the oldest are dropped.
+    """
+
+    def __init__(self, writer, capacity=10000, flush_size=200, flush_interval=1.0):
+        self.writer = writer
+        self.capacity = capacity
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._rows = collections.deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._stats = {
+            "appended": 0,
+            "flushed": 0,
+            "flushes": 0,
+            "dropped": 0,
+            "failed": 0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # Rows buffered in the parent stay with the parent.
+        self._rows = collections.deque(maxlen=self.capacity)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._loop, name="audit-flusher", daemon=True)
+                self._thread.start()
+
+    def append(self, action, table, details=""):
+        self._ensure_started()
+        row = (action, table, details, datetime.datetime.utcnow().isoformat())
+        with self._cond:
+            if len(self._rows) == self.capacity:
+                self._stats["dropped"] += 1
+            self._rows.append(row)
+            self._stats["appended"] += 1
+            if len(self._rows) >= self.flush_size:
+                self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._rows) < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                break
+
+    def flush(self):
+        """Write every buffered row in a single transaction."""
+        with self._flush_lock:
+            with self._cond:
+                rows = list(self._rows)
+                self._rows.clear()
+            if not rows:
+                return 0
+            try:
+                self.writer.run(insert_audit_logs, rows)
+            except Exception as e:
+                log.warning("Failed to flush %d audit rows: %s", len(rows), e)
+                with self._cond:
+                    self._stats["failed"] += len(rows)
+                return 0
+            with self._cond:
+                self._stats["flushed"] += len(rows)
+                self._stats["flushes"] += 1
+            return len(rows)
+
+    def stop(self, timeout=5.0):
+        """Flush whatever is buffered and stop the flusher thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._rows)
+        stats["capacity"] = self.capacity
+        stats["flush_size"] = self.flush_size
+        stats["flush_interval"] = self.flush_interval
+        return stats
+
+
+class AuditRetention:
+    """Archive and prune old audit rows in small steps.
+
+    Rows older than ``max_age_days``, or beyond the newest ``max_rows``, are
+    copied oldest first into gzip NDJSON segments under ``archive_dir``, one
+    directory per day (``YYYY-MM-DD/audit-<first id>-<last id>.ndjson.gz``),
+    and then deleted through the writer one batch at a time. A segment is
+    named by its id range, so re-archiving a batch after a crash between
+    the two steps rewrites the same file. Freed pages are handed back with
+    ``incremental_vacuum``, ``vacuum_pages`` per write transaction, so no
+    single step holds the write lock for long.
+    """
+
+    def __init__(self, pool, writer, archive_dir, max_age_days=90.0, max_rows=0,
+                 batch_size=5000, max_batches=20, vacuum_pages=256, max_vacuum_steps=40,
+                 timestamp_skew=120.0):
+        self.pool = pool
+        self.writer = writer
+        self.archive_dir = archive_dir
+        self.max_age_days = max_age_days
+        self.timestamp_skew = timestamp_skew
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.vacuum_pages = vacuum_pages
+        self.max_vacuum_steps = max_vacuum_steps
+        self._stats = {
+            "archived": 0,
+            "deleted": 0,
+            "segments_written": 0,
+            "pages_freed": 0,
+            "last_cutoff_id": None,
+        }
+
+    def cutoff_id(self, conn):
+        """Highest audit id that falls outside the retention policy, or None.
+
+        By age the cutoff is conservative: rows stamped within
+        ``timestamp_skew`` of the limit wait for a later pass.
+        """
+        cutoffs = []
+        if self.max_age_days:
+            before = (datetime.datetime.utcnow() - datetime.timedelta(days=self.max_age_days)).isoformat()
+            lowest_kept = lower_id_bound(conn, before, self.timestamp_skew)
+            if lowest_kept is not None:
+                cutoffs.append(lowest_kept - 1)
+        if self.max_rows:
+            row = conn.execute("SELECT id FROM audit_logs ORDER BY id DESC LIMIT 1 OFFSET ?",
+                               (self.max_rows,)).fetchone()
+            if row:
+                cutoffs.append(row[0])
+        return max(cutoffs) if cutoffs else None
+
+    def _write_segment(self, day, rows):
+        directory = os.path.join(self.archive_dir, day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"audit-{rows[0][0]:012d}-{rows[-1][0]:012d}.ndjson.gz")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for r in rows:
+                    f.write(json.dumps({"id": r[0], "action": r[1], "table": r[2],
+                                        "details": r[3], "timestamp": r[4]}).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+        self._stats["segments_written"] += 1
+
+    def archive_batch(self, cutoff):
+        """Archive and delete up to ``batch_size`` rows with id <= cutoff."""
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id, action, table_name, details, timestamp FROM audit_logs "
+                                "WHERE id <= ? ORDER BY id LIMIT ?", (cutoff, self.batch_size)).fetchall()
+        if not rows:
+            return 0
+        by_day = collections.defaultdict(list)
+        for r in rows:
+            by_day[r[4][:10]].append(r)
+        for day, day_rows in sorted(by_day.items()):
+            self._write_segment(day, day_rows)
+        self._stats["archived"] += len(rows)
+
+        first, last = rows[0][0], rows[-1][0]
+        deleted = self.writer.run(lambda conn: conn.execute(
+            "DELETE FROM audit_logs WHERE id >= ? AND id <= ?", (first, last)).rowcount)
+        self._stats["deleted"] += deleted
+        return deleted
+
+    def vacuum(self):
+        """Release free pages back to the filesystem in short write transactions."""
+        with self.pool.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        def step(conn, pages):
+            # Python's sqlite3 steps a row-less PRAGMA once, and each step of
+            # incremental_vacuum frees one page.
+            for _ in range(pages):
+                conn.execute("PRAGMA incremental_vacuum")
+            return pages
+
+        freed = 0
+        for _ in range(self.max_vacuum_steps):
+            if free - freed <= 0:
+                break
+            freed += self.writer.run(step, min(self.vacuum_pages, free - freed))
+        self._stats["pages_freed"] += freed
+        return freed
+
+    def run_once(self):
+        """One retention pass: archive and delete up to ``max_batches`` batches, then vacuum."""
+        with self.pool.connection() as conn:
+            cutoff = self.cutoff_id(conn)
+        self._stats["last_cutoff_id"] = cutoff
+        deleted = 0
+        if cutoff is not None:
+            for _ in range(self.max_batches):
+                n = self.archive_batch(cutoff)
+                deleted += n
+                if n < self.batch_size:
+                    break
+        freed = self.vacuum()
+        if deleted or freed:
+            log.info("Audit retention: deleted %d rows up to id %s, freed %d pages", deleted, cutoff, freed)
+        return {"deleted": deleted, "pages_freed": freed}
+
+    def query_archive(self, since=None, until=None, before_id=None, action=None, table_name=None, limit=100):
+        """Archived rows newest first, filtered like GET /audit; returns (items, next before_id)."""
+        if not os.path.isdir(self.archive_dir):
+            return [], None
+        items = []
+        for day in sorted(os.listdir(self.archive_dir), reverse=True):
+            if (since and day < since[:10]) or (until and day > until[:10]):
+                continue
+            directory = os.path.join(self.archive_dir, day)
+            segments = sorted((name for name in os.listdir(directory) if name.endswith(".ndjson.gz")),
+                              reverse=True)
+            for name in segments:
+                first_id = int(name.split("-")[1])
+                if before_id is not None and first_id >= before_id:
+                    continue
+                with gzip.open(os.path.join(directory, name), "rt") as f:
+                    rows = [json.loads(line) for line in f]
+                for row in reversed(rows):
+                    if before_id is not None and row["id"] >= before_id:
+                        continue
+                    if since and row["timestamp"] < since:
+                        continue
+                    if until and row["timestamp"] >= until:
+                        continue
+                    if action and row["action"] != action:
+                        continue
+                    if table_name and row["table"] != table_name:
+                        continue
+                    items.append(row)
+                    if len(items) == limit:
+                        return items, row["id"]
+        return items, None
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["max_age_days"] = self.max_age_days
+        stats["max_rows"] = self.max_rows
+        stats["archive_dir"] = self.archive_dir
+        return stats
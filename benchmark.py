@@ -0,0 +1,278 @@
+"""Load-test harness for the Daydream Sydney API.
+
+Starts the app against a throwaway database (or targets ``--url``), then
+drives it from ``--concurrency`` client threads with either a synthetic
+check-in mix (tap bursts, NFC lookups, dashboard polls, star creation) or
+requests replayed from a JSONL file. Latency percentiles and throughput
+are reported per endpoint and written as JSON for comparing runs:
+
+    python benchmark.py --concurrency 32 --duration 30 --out before.json
+    python benchmark.py --replay traffic.jsonl --out after.json
+
+Replay lines are objects with ``method`` and ``path`` and optionally
+``body`` and ``headers``; lines without ``method``/``path`` are skipped.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+DEFAULT_MIX = {"tap": 50, "lookup": 30, "dashboard": 15, "star": 5}
+TAP_DAYS = 60
+
+
+def start_local_server(users):
+    """Serve main.app on an ephemeral port against a fresh temp database."""
+    workdir = tempfile.mkdtemp(prefix="sydney-bench-")
+    os.environ["DB_FILE"] = os.path.join(workdir, "bench.db")
+    # Every tap should reach the database; the retry debounce would answer
+    # repeated synthetic taps from memory.
+    os.environ.setdefault("TAP_DEBOUNCE_SECONDS", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import main
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    def seed(conn):
+        conn.executemany("INSERT OR IGNORE INTO users (id, name, email) VALUES (?, ?, ?)",
+                         [(f"bench-user-{i}", f"Bench User {i}", f"bench{i}@example.com") for i in range(users)])
+        conn.executemany("INSERT OR IGNORE INTO nfc_tags (tag_id, user_id) VALUES (?, ?)",
+                         [(f"BENCH{i:08X}", f"bench-user-{i}") for i in range(users)])
+
+    main.writer.run(seed)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def synthetic_requests(users, rng, mix):
+    """Yield (label, method, path, body, headers[, etag store]) tuples forever."""
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    today = datetime.date.today()
+    etags = {}
+    star_seq = 0
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+        n = rng.randrange(users)
+        if kind == "tap":
+            # Bursts: a handful of taps from neighbouring readers at once.
+            # Dates and statuses vary so that, against a server that debounces
+            # retries (--url), repeats of one (tag, date, status) stay rare.
+            for i in range(rng.randint(1, 5)):
+                date = (today - datetime.timedelta(days=rng.randrange(TAP_DAYS))).isoformat()
+                body = {"tag_id": f"BENCH{(n + i) % users:08X}", "status": rng.choice(("present", "absent")),
+                        "date": date}
+                yield "POST /attendance", "POST", "/attendance", body, {}
+        elif kind == "lookup":
+            yield "GET /nfc/<tag>/user", "GET", f"/nfc/BENCH{n:08X}/user", None, {}
+        elif kind == "dashboard":
+            path = rng.choice([f"/attendance?date={today.isoformat()}", "/users?limit=100", "/audit?limit=100",
+                               f"/attendance/summary?date={today.isoformat()}"])
+            headers = {"If-None-Match": etags[path]} if path in etags else {}
+            yield f"GET {path.split('?')[0]}", "GET", path, None, headers, etags
+        else:
+            star_seq += 1
+            body = {"id": f"bench-star-{threading.get_ident()}-{star_seq}", "user_id": f"bench-user-{n}"}
+            yield "POST /stars", "POST", "/stars", body, {}
+
+
+def replay_requests(path):
+    entries = []
+    skipped = 0
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(entry, dict) or "method" not in entry or "path" not in entry:
+                skipped += 1
+                continue
+            method = entry["method"].upper()
+            label = f"{method} {urllib.parse.urlsplit(entry['path']).path}"
+            entries.append((label, method, entry["path"], entry.get("body"), entry.get("headers", {})))
+    return entries, skipped
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.not_modified = {}
+
+    def record(self, label, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(label, []).append(seconds)
+            if status >= 400 or status == 0:
+                self.errors[label] = self.errors.get(label, 0) + 1
+            elif status == 304:
+                self.not_modified[label] = self.not_modified.get(label, 0) + 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, not_modified, wall):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "not_modified": not_modified,
+        "throughput_rps": round(len(values) / wall, 2) if wall else None,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+        "max_ms": round(values[-1] * 1000, 3) if values else None,
+    }
+
+
+def client_worker(base_url, source, recorder, deadline, remaining, lock):
+    parts = urllib.parse.urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    while time.monotonic() < deadline:
+        with lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            item = next(source)
+        label, method, path, body, headers = item[:5]
+        etags = item[5] if len(item) > 5 else None
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = dict(headers)
+        if payload is not None:
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            if etags is not None and response.getheader("ETag"):
+                etags[path] = response.getheader("ETag")
+            if response.getheader("Connection", "").lower() == "close":
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            status = 0
+            conn.close()
+        recorder.record(label, time.perf_counter() - start, status)
+    conn.close()
+
+
+def run(args):
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        server, base_url = start_local_server(args.users)
+
+    rng = random.Random(args.seed)
+    if args.replay:
+        entries, skipped = replay_requests(args.replay)
+        print(f"Replaying {len(entries)} requests from {args.replay} ({skipped} lines skipped)")
+        if not entries:
+            print("Nothing replayable; falling back to the synthetic mix")
+    else:
+        entries = None
+
+    if entries:
+        source = iter(entries * max(1, args.loops))
+        total = len(entries) * max(1, args.loops)
+    else:
+        mix = dict(DEFAULT_MIX)
+        for part in filter(None, (args.mix or "").split(",")):
+            kind, weight = part.split("=")
+            mix[kind] = int(weight)
+        source = synthetic_requests(args.users, rng, mix)
+        total = args.requests
+
+    recorder = Recorder()
+    lock = threading.Lock()
+    remaining = [total]
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=client_worker,
+                                args=(base_url, source, recorder, deadline, remaining, lock))
+               for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.monotonic() - started
+
+    endpoints = {
+        label: summarize(values, recorder.errors.get(label, 0), recorder.not_modified.get(label, 0), wall)
+        for label, values in sorted(recorder.latencies.items())
+    }
+    all_latencies = [v for values in recorder.latencies.values() for v in values]
+    results = {
+        "started_at": datetime.datetime.utcnow().isoformat(),
+        "target": base_url if args.url else "local",
+        "config": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "users": args.users,
+            "replay": args.replay,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "wall_seconds": round(wall, 3),
+        "total": summarize(all_latencies, sum(recorder.errors.values()),
+                           sum(recorder.not_modified.values()), wall),
+        "endpoints": endpoints,
+    }
+
+    print(f"{'endpoint':<32}{'count':>8}{'err':>6}{'rps':>10}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for label, s in list(endpoints.items()) + [("TOTAL", results["total"])]:
+        print(f"{label:<32}{s['count']:>8}{s['errors']:>6}{s['throughput_rps'] or 0:>10.1f}"
+              f"{s['p50_ms'] or 0:>9.2f}{s['p95_ms'] or 0:>9.2f}{s['p99_ms'] or 0:>9.2f}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+
+    if server is not None:
+        server.shutdown()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads (default 16)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (default 10)")
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    parser.add_argument("--users", type=int, default=500, help="users/tags to seed and target (default 500)")
+    parser.add_argument("--mix", help="synthetic weights, e.g. tap=60,lookup=30,dashboard=10,star=0")
+    parser.add_argument("--replay", help="JSONL file of requests to replay")
+    parser.add_argument("--loops", type=int, default=1, help="times to replay the file (default 1)")
+    parser.add_argument("--seed", type=int, default=1234, help="random seed for the synthetic mix")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
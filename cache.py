@@ -0,0 +1,122 @@
+import collections
+import os
+import threading
+import time
+
+
+class TagCache:
+    """Bounded LRU/TTL cache of NFC tag id -> user record.
+
+    Writers invalidate entries by tag or by user after they commit. Readers
+    take a ``generation()`` token before querying the database and pass it
+    to ``put``; if anything was invalidated in between, the possibly stale
+    record is not cached. Writes made by other processes are noticed through
+    table_versions: readers call ``resync`` at most once per
+    ``resync_interval`` and the whole cache is dropped when they moved.
+    """
+
+    def __init__(self, max_size=10000, ttl=300.0, resync_interval=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.resync_interval = resync_interval
+        self._versions = None
+        self._resynced_at = 0.0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._tags_by_user = collections.defaultdict(set)
+        self._generation = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "resync_clears": 0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, tag_id):
+        """Return the cached user record for ``tag_id``, or None."""
+        with self._lock:
+            entry = self._entries.get(tag_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                self._remove(tag_id)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(tag_id)
+            self._stats["hits"] += 1
+            return user
+
+    def put(self, tag_id, user, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            if tag_id in self._entries:
+                self._remove(tag_id)
+            self._entries[tag_id] = (time.monotonic() + self.ttl, user)
+            self._tags_by_user[user["id"]].add(tag_id)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def _remove(self, tag_id):
+        _, user = self._entries.pop(tag_id)
+        tags = self._tags_by_user.get(user["id"])
+        if tags is not None:
+            tags.discard(tag_id)
+            if not tags:
+                del self._tags_by_user[user["id"]]
+
+    def invalidate_tag(self, tag_id):
+        with self._lock:
+            self._generation += 1
+            if tag_id in self._entries:
+                self._remove(tag_id)
+                self._stats["invalidations"] += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generation += 1
+            for tag_id in list(self._tags_by_user.get(user_id, ())):
+                self._remove(tag_id)
+                self._stats["invalidations"] += 1
+
+    def needs_resync(self):
+        return time.monotonic() - self._resynced_at >= self.resync_interval
+
+    def resync(self, versions):
+        """Record the current table versions; clear the cache if they changed."""
+        with self._lock:
+            self._resynced_at = time.monotonic()
+            if versions == self._versions:
+                return
+            self._versions = versions
+        self.clear()
+        self._stats["resync_clears"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        stats["max_size"] = self.max_size
+        stats["ttl"] = self.ttl
+        stats["resync_interval"] = self.resync_interval
+        return stats
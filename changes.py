@@ -0,0 +1,145 @@
+import datetime
+import itertools
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+# entity table -> (key column, columns carried in the payload, columns whose
+# update is a change). updated_at is left out on purpose: the *_updated_at
+# triggers rewrite it with a nested UPDATE, and listing it would record every
+# edit twice. The change's own created_at says when the row last changed.
+CHANGE_ENTITIES = {
+    "users": ("id", ("id", "name", "email", "created_at"), ("name", "email")),
+    "stars": ("id", ("id", "user_id", "created_at"), ("user_id",)),
+    "nfc_tags": ("tag_id", ("tag_id", "user_id", "created_at"), ("user_id",)),
+    "attendance": ("id", ("id", "tag_id", "user_id", "status", "date", "created_at"),
+                   ("tag_id", "user_id", "status", "date")),
+}
+
+CHANGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        entity_id TEXT NOT NULL,
+        op TEXT NOT NULL,
+        payload TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def change_triggers():
+    """(name, CREATE TRIGGER statement) for every entity table and event."""
+    for table, (key, columns, updatable) in CHANGE_ENTITIES.items():
+        payload = "json_object(" + ", ".join(f"'{col}', NEW.{col}" for col in columns) + ")"
+        yield f"{table}_changes_insert", f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO changes (entity, entity_id, op, payload)
+                VALUES ('{table}', NEW.{key}, 'INSERT', {payload});
+            END;
+        """
+        # Re-taps and upserts that write the same values are not changes.
+        changed = " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in updatable)
+        yield f"{table}_changes_update", f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_update
+            AFTER UPDATE OF {", ".join(updatable)} ON {table}
+            WHEN {changed}
+            BEGIN
+                INSERT INTO changes (entity, entity_id, op, payload)
+                VALUES ('{table}', NEW.{key}, 'UPDATE', {payload});
+            END;
+        """
+        yield f"{table}_changes_delete", f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO changes (entity, entity_id, op, payload)
+                VALUES ('{table}', OLD.{key}, 'DELETE', NULL);
+            END;
+        """
+
+
+def feed_bounds(conn):
+    """(oldest, latest) retained seq, both None while the feed is empty."""
+    return conn.execute("SELECT MIN(seq), MAX(seq) FROM changes").fetchone()
+
+
+def _change(row):
+    return {"seq": row[0], "entity": row[1], "entity_id": row[2], "op": row[3],
+            "payload": json.loads(row[4]) if row[4] is not None else None, "created_at": row[5]}
+
+
+def read_changes(conn, since, limit, entity=None):
+    """Changes with seq > since in seq order, at most ``limit``.
+
+    Writes are serialised, so seqs become visible in commit order and a
+    reader that resumes from the last seq it saw never skips a change.
+    """
+    if entity:
+        rows = conn.execute("SELECT seq, entity, entity_id, op, payload, created_at FROM changes "
+                            "WHERE entity = ? AND seq > ? ORDER BY seq LIMIT ?", (entity, since, limit))
+    else:
+        rows = conn.execute("SELECT seq, entity, entity_id, op, payload, created_at FROM changes "
+                            "WHERE seq > ? ORDER BY seq LIMIT ?", (since, limit))
+    return [_change(r) for r in rows]
+
+
+def latest_changes(conn, entity, limit):
+    """The newest ``limit`` changes to ``entity``, oldest first."""
+    rows = conn.execute("SELECT seq, entity, entity_id, op, payload, created_at FROM changes "
+                        "WHERE entity = ? ORDER BY seq DESC LIMIT ?", (entity, limit)).fetchall()
+    return [_change(r) for r in reversed(rows)]
+
+
+class ChangeRetention:
+    """Delete change rows older than ``max_age_days``, oldest first, in batches.
+
+    The newest change is always kept, so the oldest retained seq tells a
+    client whether it can still catch up from where it stopped. Freed pages
+    are returned by the audit retention job's incremental vacuum.
+    """
+
+    def __init__(self, pool, writer, max_age_days=30.0, batch_size=5000, max_batches=20):
+        self.pool = pool
+        self.writer = writer
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._stats = {"deleted": 0, "last_oldest_seq": None}
+
+    def prune_batch(self, conn, before):
+        # Seqs are assigned in time order, so the expired rows are a prefix;
+        # reading from the front keeps each step a short range scan.
+        rows = conn.execute("SELECT seq, created_at FROM changes WHERE seq < (SELECT MAX(seq) FROM changes) "
+                            "ORDER BY seq LIMIT ?", (self.batch_size,)).fetchall()
+        expired = list(itertools.takewhile(lambda row: row[1] < before, rows))
+        if not expired:
+            return 0
+        return conn.execute("DELETE FROM changes WHERE seq <= ?", (expired[-1][0],)).rowcount
+
+    def run_once(self):
+        """One retention pass of up to ``max_batches`` batches; returns rows deleted."""
+        if not self.max_age_days:
+            return 0
+        before = (datetime.datetime.utcnow() - datetime.timedelta(days=self.max_age_days)).strftime(
+            "%Y-%m-%d %H:%M:%S")
+        deleted = 0
+        for _ in range(self.max_batches):
+            n = self.writer.run(self.prune_batch, before)
+            deleted += n
+            if n < self.batch_size:
+                break
+        self._stats["deleted"] += deleted
+        with self.pool.connection() as conn:
+            self._stats["last_oldest_seq"] = feed_bounds(conn)[0]
+        if deleted:
+            log.info("Change retention: deleted %d rows", deleted)
+        return deleted
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["max_age_days"] = self.max_age_days
+        return stats
@@ -0,0 +1,532 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process write coordination
+    fcntl = None
+
+SQL_SECONDS = metrics.REGISTRY.histogram(
+    "sqlite_statement_duration_seconds", "Time spent executing statements and fetching their rows.",
+    ("statement", "phase"))
+SQL_LOCKED = metrics.REGISTRY.counter(
+    "sqlite_database_locked_total", "Statements that failed with 'database is locked' after busy_timeout.",
+    ("statement",))
+CONNECTIONS_OPENED = metrics.REGISTRY.counter(
+    "sqlite_connections_opened_total", "SQLite connections opened by the pool.")
+CONNECTIONS_CLOSED = metrics.REGISTRY.counter(
+    "sqlite_connections_closed_total", "SQLite connections closed by the pool.")
+WRITE_QUEUE_WAIT = metrics.REGISTRY.histogram(
+    "db_write_queue_wait_seconds", "Time a write op waited in the queue before the writer ran it.")
+WRITE_TRANSACTION = metrics.REGISTRY.histogram(
+    "db_write_transaction_seconds", "Time the writer held a write transaction, BEGIN IMMEDIATE to COMMIT.")
+WRITE_LOCK_WAIT = metrics.REGISTRY.histogram(
+    "db_write_lock_wait_seconds", "Time spent waiting for the cross-process write lock.")
+
+log = logging.getLogger(__name__)
+
+# run() without a timeout argument uses the writer's own default.
+_DEFAULT = object()
+
+MAX_STATEMENT_LABELS = 500
+# Schema statements run once at startup; timing them only adds series.
+UNTIMED_KEYWORDS = ("CREATE", "DROP", "ALTER")
+_statement_labels = {}
+
+
+def statement_label(sql):
+    """Whitespace-normalised SQL used as a metric label, or None for DDL; bounded cardinality."""
+    try:
+        return _statement_labels[sql]
+    except KeyError:
+        pass
+    if len(_statement_labels) >= MAX_STATEMENT_LABELS:
+        return "other"
+    label = " ".join(sql.split())[:200]
+    if label.upper().startswith(UNTIMED_KEYWORDS):
+        label = None
+    _statement_labels[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement and fetch timings."""
+
+    _statement = "other"
+
+    def _timed(self, method, phase, *args):
+        if self._statement is None:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        except sqlite3.OperationalError as e:
+            if "database is locked" in str(e):
+                SQL_LOCKED.inc(self._statement)
+            raise
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - start, self._statement, phase)
+
+    def execute(self, sql, parameters=()):
+        self._statement = statement_label(sql)
+        return self._timed(super().execute, "execute", sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._statement = statement_label(sql)
+        return self._timed(super().executemany, "execute", sql, seq_of_parameters)
+
+    def fetchone(self):
+        return self._timed(super().fetchone, "fetch")
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, "fetch", size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, "fetch")
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute does not go through cursor(), so route it explicitly.
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """Pool of long-lived SQLite connections.
+
+    Each worker thread checks a connection out for the duration of a request
+    and hands it back afterwards, so PRAGMAs are applied once per connection
+    instead of once per request. Connections are health-checked when they
+    have been idle for a while and recycled after a maximum age or number of
+    uses.
+    """
+
+    def __init__(self, db_file, timeout=30.0, max_idle=8, max_age=3600.0,
+                 max_uses=100000, check_after=30.0):
+        self.db_file = db_file
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.check_after = check_after
+        self._lock = threading.Lock()
+        self._idle = []
+        self._stats = {
+            "opened": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "reused": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "in_use": 0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # SQLite connections must not cross a fork: drop the parent's without
+        # closing them, so each worker opens its own.
+        self._lock = threading.Lock()
+        self._idle = []
+        self._stats["in_use"] = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False,
+                               factory=TimedConnection)
+        # auto_vacuum only takes effect on a database that does not exist yet,
+        # so it has to be set before journal_mode writes the file header.
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)};')
+        with self._lock:
+            self._stats["opened"] += 1
+        CONNECTIONS_OPENED.inc()
+        return {"conn": conn, "created": time.monotonic(), "last_used": time.monotonic(), "uses": 0}
+
+    def _close(self, entry):
+        try:
+            entry["conn"].close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._stats["closed"] += 1
+        CONNECTIONS_CLOSED.inc()
+
+    def _healthy(self, entry):
+        now = time.monotonic()
+        if now - entry["created"] > self.max_age or entry["uses"] >= self.max_uses:
+            with self._lock:
+                self._stats["recycled"] += 1
+            return False
+        if now - entry["last_used"] > self.check_after:
+            try:
+                entry["conn"].execute("SELECT 1").fetchone()
+            except sqlite3.Error:
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                return False
+        return True
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if none is idle."""
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                entry = self._open()
+                break
+            if self._healthy(entry):
+                with self._lock:
+                    self._stats["reused"] += 1
+                break
+            self._close(entry)
+        entry["uses"] += 1
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+        return entry
+
+    def discard(self, entry):
+        """Close a checked-out connection instead of returning it, e.g. after it broke."""
+        with self._lock:
+            self._stats["in_use"] -= 1
+        self._close(entry)
+
+    def release(self, entry):
+        """Return a connection to the pool, rolling back any open transaction."""
+        conn = entry["conn"]
+        with self._lock:
+            self._stats["in_use"] -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._close(entry)
+            return
+        entry["last_used"] = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(entry)
+                return
+        self._close(entry)
+
+    @contextmanager
+    def connection(self):
+        entry = self.acquire()
+        try:
+            yield entry["conn"]
+        finally:
+            self.release(entry)
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = len(self._idle)
+        stats["max_idle"] = self.max_idle
+        return stats
+
+
+class FileWriteLock:
+    """Exclusive advisory lock shared by every process writing one database.
+
+    Each worker's writer thread holds it for exactly one group commit, so
+    writers in different processes take turns instead of spinning on
+    SQLite's busy timeout, and whatever queued up while a worker waited is
+    committed in its next group.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._stats = {
+            "acquisitions": 0,
+            "contended": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # flock belongs to the open file description, which a fork shares;
+        # the child must open its own or it would share the parent's lock.
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        start = time.monotonic()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._stats["contended"] += 1
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        waited = time.monotonic() - start
+        WRITE_LOCK_WAIT.observe(waited)
+        self._stats["acquisitions"] += 1
+        self._stats["wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+
+    def try_acquire(self):
+        """Take the lock only if it is free; returns whether it was taken."""
+        if fcntl is None:
+            return True
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["enabled"] = fcntl is not None
+        return stats
+
+
+class GroupCommitWriter:
+    """Single writer thread that commits queued write operations in groups.
+
+    Callers submit ``op(conn, *args)`` callables and get a Future back. The
+    writer drains up to ``max_batch`` ops, waiting at most ``max_delay``
+    seconds for more to arrive, runs each op inside its own savepoint and
+    commits the whole group with a single COMMIT. An op that raises only
+    rolls back its own savepoint; its Future carries the exception.
+
+    With a ``write_lock`` the group is committed while holding it, and ops
+    that queued up while waiting for the lock join the same group. If the
+    group itself fails (the lock, a savepoint, the commit), every op in it
+    gets that exception and the writer carries on with the next group.
+    """
+
+    def __init__(self, pool, max_batch=64, max_delay=0.002, write_lock=None, timeout=None):
+        self.pool = pool
+        self.write_lock = write_lock
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._entry = None
+        self._stats = {
+            "submitted": 0,
+            "committed": 0,
+            "failed": 0,
+            "batches": 0,
+            "largest_batch": 0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The writer thread does not survive a fork; the child starts its own
+        # on the first submit.
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._entry = None
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, op, *args):
+        """Queue ``op(conn, *args)`` for the writer thread and return a Future."""
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Ops issued from inside another op join the running transaction.
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(op(self._entry["conn"], *args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_started()
+        with self._lock:
+            self._stats["submitted"] += 1
+        self._queue.put((future, op, args, time.perf_counter()))
+        return future
+
+    def run(self, op, *args, timeout=_DEFAULT):
+        """Submit ``op`` and block until its group has been committed.
+
+        Raises concurrent.futures.TimeoutError after ``timeout`` seconds
+        (the writer's default unless given; None waits indefinitely). The op
+        stays queued and may still commit after the caller gave up.
+        """
+        return self.submit(op, *args).result(self.timeout if timeout is _DEFAULT else timeout)
+
+    def _collect(self, batch, delay):
+        deadline = time.monotonic() + delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _fail(self, batch, error):
+        failed = 0
+        for future, _, _, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+                failed += 1
+        with self._lock:
+            self._stats["failed"] += failed
+
+    def _open_entry(self):
+        entry = self.pool.acquire()
+        entry["conn"].isolation_level = None
+        return entry
+
+    def _recover(self):
+        """Roll back whatever a failed group left open, or replace the connection."""
+        conn = self._entry["conn"]
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return
+        except sqlite3.Error:
+            log.exception("Writer connection unusable, reopening")
+        self.pool.discard(self._entry)
+        self._entry = self._open_entry()
+
+    def _loop(self):
+        try:
+            self._entry = self._open_entry()
+        except Exception as e:
+            log.exception("Writer could not open a connection")
+            # Fail what is queued now; the next submit starts a new thread.
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._fail([item], e)
+            return
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    break
+                batch = self._collect([first], self.max_delay)
+                try:
+                    if self.write_lock is None:
+                        self._commit_batch(self._entry["conn"], batch)
+                        continue
+                    self.write_lock.acquire()
+                    try:
+                        self._commit_batch(self._entry["conn"], self._collect(batch, 0))
+                    finally:
+                        self.write_lock.release()
+                except Exception as e:
+                    log.exception("Write group of %d ops failed", len(batch))
+                    self._fail(batch, e)
+                    self._recover()
+        finally:
+            self._entry["conn"].isolation_level = ""
+            self.pool.release(self._entry)
+            self._entry = None
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        for _, _, _, queued in batch:
+            WRITE_QUEUE_WAIT.observe(started - queued)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            for future, _, _, _ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            with self._lock:
+                self._stats["failed"] += len(batch)
+            return
+
+        for future, op, args, _ in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            conn.execute("SAVEPOINT op")
+            try:
+                results.append((future, op(conn, *args), None))
+                conn.execute("RELEASE op")
+            except Exception as e:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                results.append((future, None, e))
+
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for future, _, _ in results]
+        WRITE_TRANSACTION.observe(time.perf_counter() - started)
+
+        failed = 0
+        for future, result, error in results:
+            if error is not None:
+                failed += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["committed"] += len(results) - failed
+            self._stats["failed"] += failed
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+    def stop(self, timeout=5.0):
+        """Commit everything already queued and stop the writer thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["max_batch"] = self.max_batch
+        stats["max_delay_ms"] = self.max_delay * 1000
+        if self.write_lock is not None:
+            stats["write_lock"] = self.write_lock.stats()
+        return stats
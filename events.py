@@ -0,0 +1,217 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+from changes import latest_changes, read_changes
+
+log = logging.getLogger(__name__)
+
+
+class EventBroker:
+    """In-process fan-out of events to Server-Sent Events subscribers.
+
+    Published events are kept in a bounded history so a reconnecting client
+    can resume from its Last-Event-ID. Subscribers share one condition
+    variable and read straight from the history, so publishing costs the
+    same however many clients are listening. Event ids are supplied by the
+    publisher and only move forward; a ChangeTail publishes with the change
+    seq, so every worker hands out the same id for the same event.
+    ``max_subscribers`` bounds the streams one process serves, since each
+    holds a server thread while it is open.
+    """
+
+    def __init__(self, history=1000, heartbeat=15.0, max_subscribers=0):
+        self.heartbeat = heartbeat
+        self.max_subscribers = max_subscribers
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=history)
+        self._last_id = 0
+        self._subscribers = 0
+        self._published = 0
+        self._listeners = []
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._cond = threading.Condition()
+        self._subscribers = 0
+        # The child's tail loads its own history when its first stream opens.
+        self._events.clear()
+        self._last_id = 0
+
+    def full(self):
+        """True when ``max_subscribers`` streams are already open."""
+        with self._cond:
+            return bool(self.max_subscribers) and self._subscribers >= self.max_subscribers
+
+    @property
+    def history(self):
+        return self._events.maxlen
+
+    def publish(self, event_id, event_type, data):
+        with self._cond:
+            if event_id <= self._last_id:
+                return
+            self._last_id = event_id
+            self._events.append((event_id, event_type, data))
+            self._published += 1
+            self._cond.notify_all()
+        for callback in self._listeners:
+            callback()
+
+    def add_listener(self, callback):
+        """Call ``callback()`` from the publishing thread after every event."""
+        self._listeners.append(callback)
+
+    def events_since(self, cursor):
+        """Return ``(events newer than cursor, latest event id)`` without blocking."""
+        with self._cond:
+            return self._since(cursor), self._last_id
+
+    def format(self, event_id, event_type, data):
+        return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    def _since(self, cursor):
+        """Events newer than ``cursor``; the caller holds the condition."""
+        if self._last_id <= cursor:
+            return []
+        # Ids have gaps, so walk back from the newest to the first one seen.
+        newer = []
+        for event in reversed(self._events):
+            if event[0] <= cursor:
+                break
+            newer.append(event)
+        newer.reverse()
+        return newer
+
+    def subscribe(self, last_event_id=None, match=None):
+        """Yield SSE-formatted chunks, replaying history after ``last_event_id``."""
+        with self._cond:
+            cursor = self._last_id if last_event_id is None else last_event_id
+            self._subscribers += 1
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                with self._cond:
+                    if self._last_id <= cursor:
+                        self._cond.wait(self.heartbeat)
+                    events = self._since(cursor)
+                    cursor = max(cursor, self._last_id)
+                if not events:
+                    yield ": keepalive\n\n"
+                    continue
+                for event_id, event_type, data in events:
+                    if match is None or match(data):
+                        yield self.format(event_id, event_type, data)
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "subscribers": self._subscribers,
+                "max_subscribers": self.max_subscribers,
+                "published": self._published,
+                "history": len(self._events),
+                "last_event_id": self._last_id,
+            }
+
+
+class ChangeTail:
+    """Publishes one entity's rows from the ``changes`` table into a broker.
+
+    Taps are committed by whichever worker took the request, so each process
+    follows the shared change feed instead of its own writes: a stream shows
+    every worker's taps, and since events carry the change seq as their id,
+    a client that reconnects to another worker resumes where it stopped.
+    The tail starts with the newest ``broker.history`` changes, so a worker
+    that had no stream open yet can still replay a reconnect, and then polls
+    every ``interval`` seconds with an index range scan; ``wake()`` polls at
+    once after this process's own commits. Deletes carry no payload and are
+    not published.
+    """
+
+    def __init__(self, broker, pool, entity, event_type, interval=0.5, batch_size=500):
+        self.broker = broker
+        self.pool = pool
+        self.entity = entity
+        self.event_type = event_type
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._cursor = 0
+        self._stats = {"polls": 0, "published": 0, "failures": 0}
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The thread stays in the parent; the child starts its own on demand.
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._cursor = 0
+
+    def start(self):
+        """Load recent history and start polling, once per process."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            with self.pool.connection() as conn:
+                self._publish(latest_changes(conn, self.entity, self.broker.history))
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name=f"tail-{self.entity}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def _publish(self, changes):
+        for change in changes:
+            self._cursor = change["seq"]
+            if change["payload"] is not None:
+                self.broker.publish(change["seq"], self.event_type, change["payload"])
+                self._stats["published"] += 1
+
+    def poll(self):
+        """Publish changes committed since the last poll; returns how many were read."""
+        read = 0
+        with self.pool.connection() as conn:
+            while True:
+                changes = read_changes(conn, self._cursor, self.batch_size, self.entity)
+                self._publish(changes)
+                read += len(changes)
+                if len(changes) < self.batch_size:
+                    return read
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self._stats["polls"] += 1
+            try:
+                self.poll()
+            except Exception:
+                self._stats["failures"] += 1
+                log.exception("Polling %s changes failed", self.entity)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["cursor"] = self._cursor
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        stats["interval"] = self.interval
+        return stats
@@ -0,0 +1,193 @@
+"""Bulk-load a synthetic dataset into the real schema for capacity testing.
+
+    python generate_data.py --db capacity.db --users 100000 --days 100 --start-date 2025-01-01 --seed 7
+
+Creates users, NFC tags, stars, attendance (one row per user per day with
+probability ``--attendance-rate``) and audit logs in a new database file;
+an existing file is refused. With ``--start-date`` the same arguments and
+seed always produce the same database; without it the dates end today and
+move with the calendar. The app's sample user is not added. Rows are
+inserted in large executemany batches with journaling and fsync turned
+off. The rollup, table-version and change-feed triggers are dropped for
+the load and recreated afterwards, and the rollups and star counts are
+rebuilt once at the end. The generated rows are not in the change feed;
+clients start from a full load, as they would after falling outside its
+retention window.
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+
+DEFERRED_TRIGGERS = (
+    "attendance_rollup_insert",
+    "attendance_rollup_delete",
+    "attendance_rollup_update",
+    "stars_count_insert",
+    "stars_count_delete",
+    "stars_count_update",
+)
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def timestamp(day, rng):
+    moment = datetime.datetime.combine(day, datetime.time(7, 0)) + datetime.timedelta(seconds=rng.randrange(36000))
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def generate_users(args, rng, start):
+    for i in range(args.users):
+        created = timestamp(start - datetime.timedelta(days=rng.randrange(365)), rng)
+        yield (f"gen-user-{i:07d}", f"User {i}", f"user{i}@example.com", created, created)
+
+
+def generate_tags(args, rng, start):
+    for i in range(args.users):
+        for t in range(args.tags_per_user):
+            created = timestamp(start, rng)
+            yield (f"GEN{i:07d}{t:02d}", f"gen-user-{i:07d}", created, created)
+
+
+def generate_stars(args, rng, start, days):
+    for i in range(args.users):
+        # Geometric number of stars per user with the requested mean.
+        count = 0
+        while rng.random() < args.stars_per_user / (args.stars_per_user + 1.0):
+            count += 1
+        for s in range(count):
+            day = start + datetime.timedelta(days=rng.randrange(days))
+            yield (f"gen-star-{i:07d}-{s}", f"gen-user-{i:07d}", timestamp(day, rng))
+
+
+def generate_attendance(args, rng, start, days):
+    for d in range(days):
+        day = start + datetime.timedelta(days=d)
+        date = day.isoformat()
+        for i in range(args.users):
+            if rng.random() >= args.attendance_rate:
+                continue
+            status = "present" if rng.random() < args.present_rate else "absent"
+            created = timestamp(day, rng)
+            yield (f"GEN{i:07d}00", f"gen-user-{i:07d}", status, date, created, created)
+
+
+def generate_audit(args, rng, start, days):
+    # Ids follow timestamps; the running service keeps them within AUDIT_TIMESTAMP_SKEW.
+    total_seconds = days * 86400
+    step = total_seconds / max(1, args.audit_rows)
+    base = datetime.datetime.combine(start, datetime.time())
+    actions = [("INSERT", "attendance"), ("UPDATE", "attendance"), ("INSERT", "stars"),
+               ("DELETE", "stars"), ("INSERT", "nfc_tags"), ("UPDATE", "users")]
+    weights = [60, 20, 10, 4, 3, 3]
+    for n in range(args.audit_rows):
+        moment = base + datetime.timedelta(seconds=n * step)
+        action, table = rng.choices(actions, weights)[0]
+        details = f"Tag GEN{rng.randrange(args.users):07d}00 {action.lower()} on {table}"
+        yield (action, table, details, moment.isoformat())
+
+
+def load(conn, label, sql, rows, batch_size):
+    started = time.monotonic()
+    count = 0
+    for chunk in chunked(rows, batch_size):
+        conn.executemany(sql, chunk)
+        count += len(chunk)
+    conn.commit()
+    print(f"{label}: {count} rows in {time.monotonic() - started:.1f}s")
+    return count
+
+
+def main_(args):
+    if os.path.exists(args.db):
+        sys.exit(f"{args.db} already exists; generate_data.py only creates new databases")
+    os.environ["DB_FILE"] = args.db
+    os.environ["SAMPLE_DATA"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main  # creates the schema in args.db
+
+    main.pool.close_all()
+    rng = random.Random(args.seed)
+    days = args.days
+    start = (datetime.date.fromisoformat(args.start_date) if args.start_date
+             else datetime.date.today() - datetime.timedelta(days=days))
+
+    conn = sqlite3.connect(args.db)
+    try:
+        load_all(main, conn, args, rng, start, days)
+    finally:
+        conn.close()
+        # Recreate the dropped triggers, also after a failed load; the pool's
+        # connections put the journal back to WAL.
+        main.init_db()
+        main.pool.close_all()
+
+
+def load_all(main, conn, args, rng, start, days):
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")
+    for name in DEFERRED_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    for table in main.VERSIONED_TABLES:
+        for event in ("insert", "update", "delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {table}_version_{event}")
+    for name, _ in main.change_triggers():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    started = time.monotonic()
+    load(conn, "users", "INSERT INTO users (id, name, email, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+         generate_users(args, rng, start), args.batch_size)
+    load(conn, "nfc_tags", "INSERT INTO nfc_tags (tag_id, user_id, created_at, updated_at) VALUES (?, ?, ?, ?)",
+         generate_tags(args, rng, start), args.batch_size)
+    load(conn, "stars", "INSERT INTO stars (id, user_id, created_at) VALUES (?, ?, ?)",
+         generate_stars(args, rng, start, days), args.batch_size)
+    load(conn, "attendance",
+         "INSERT INTO attendance (tag_id, user_id, status, date, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+         generate_attendance(args, rng, start, days), args.batch_size)
+    load(conn, "audit_logs", "INSERT INTO audit_logs (action, table_name, details, timestamp) VALUES (?, ?, ?, ?)",
+         generate_audit(args, rng, start, days), args.batch_size)
+
+    main.rebuild_attendance_rollups(conn)
+    main.rebuild_star_counts(conn)
+    conn.execute("UPDATE table_versions SET version = version + 1")
+    conn.commit()
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("ANALYZE")
+    print(f"Done in {time.monotonic() - started:.1f}s: {args.db}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="database file to create; must not exist")
+    parser.add_argument("--users", type=int, default=1000, help="number of users (default 1000)")
+    parser.add_argument("--tags-per-user", type=int, default=1, help="NFC tags per user (default 1)")
+    parser.add_argument("--stars-per-user", type=float, default=5.0, help="mean stars per user (default 5)")
+    parser.add_argument("--days", type=int, default=30, help="days of attendance history (default 30)")
+    parser.add_argument("--start-date", help="first attendance date, YYYY-MM-DD (default: --days ago)")
+    parser.add_argument("--attendance-rate", type=float, default=0.9,
+                        help="probability a user has a row on a given day (default 0.9)")
+    parser.add_argument("--present-rate", type=float, default=0.85,
+                        help="probability a row is 'present' (default 0.85)")
+    parser.add_argument("--audit-rows", type=int, default=10000, help="audit log rows (default 10000)")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows per executemany (default 50000)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed (default 42)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main_(parse_args())
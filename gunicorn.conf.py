@@ -0,0 +1,41 @@
+import multiprocessing
+import os
+
+# Pre-fork serving mode. The app is imported once in the master (init_db and
+# populate_sample_data run there); each worker opens its own SQLite
+# connections and background threads after the fork.
+#
+# One worker per CPU by default. Writes are serialised across workers by the
+# writer's file lock, and /attendance/stream follows the shared change feed,
+# so a display sees every worker's taps and can reconnect to any of them.
+# The NFC tag cache and missing roster resync from table versions; only the
+# idempotency caches stay per worker, so a retry that reaches another worker
+# runs again, which the write paths tolerate.
+bind = f"0.0.0.0:{os.environ.get('PORT', '1234')}"
+# Each scrape lands on one worker; the workers share their metrics through
+# this directory so /metrics always reports the sum over all of them.
+os.environ.setdefault("METRICS_DIR", os.environ.get("DB_FILE", "daydream_sydney.db") + ".metrics")
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+preload_app = True
+timeout = int(os.environ.get("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+# gunicorn writes access lines synchronously from the request thread,
+# outside the app's queued logging; off unless ACCESS_LOG names a target
+# ("-" for stdout). Sampled per-request events come from main.requests.
+accesslog = os.environ.get("ACCESS_LOG") or None
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    # Background jobs start per worker, never in the master.
+    from main import start_background_jobs
+    start_background_jobs()
+
+
+def worker_exit(server, worker):
+    # Flush buffered audit rows and queued writes before the worker goes away.
+    from main import shutdown
+    shutdown()
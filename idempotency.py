@@ -0,0 +1,119 @@
+import collections
+import os
+import threading
+import time
+
+
+class _Entry:
+    __slots__ = ("expires_at", "fingerprint", "done", "response")
+
+    def __init__(self, expires_at, fingerprint):
+        self.expires_at = expires_at
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.response = None
+
+
+class IdempotencyCache:
+    """Bounded in-memory map of request key -> response, for suppressing retries.
+
+    The first request for a key becomes its owner and runs; concurrent
+    duplicates wait for the owner's response and repeat it. Each entry
+    carries a fingerprint of its request body; a request under the same key
+    with a different fingerprint is not a duplicate. Completed
+    responses are kept for ``ttl`` seconds. Every entry in one cache shares
+    the same ttl, so insertion order is expiry order and expired entries are
+    swept from the front; beyond ``max_entries`` the oldest are evicted. The
+    cache is per process: under several workers a retry that lands on
+    another worker runs again, which the write paths tolerate.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._stats = {
+            "replayed": 0,
+            "joined_in_flight": 0,
+            "superseded": 0,
+            "mismatched": 0,
+            "stored": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # In-flight owners live in the parent; start the child empty.
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def _sweep(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            del self._entries[key]
+            self._stats["expired"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def begin(self, key, fingerprint=None, replace=False):
+        """Return ``(entry, owner)``; the owner must call ``complete`` or ``abandon``.
+
+        With ``replace``, an entry whose fingerprint differs is dropped and the
+        caller becomes the owner of a new one; otherwise it is returned as is
+        and the caller must compare ``entry.fingerprint`` itself.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(key)
+            if entry is not None and replace and entry.fingerprint != fingerprint:
+                del self._entries[key]
+                self._stats["superseded"] += 1
+                entry = None
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    self._stats["mismatched"] += 1
+                elif entry.done.is_set():
+                    self._stats["replayed"] += 1
+                else:
+                    self._stats["joined_in_flight"] += 1
+                return entry, False
+            entry = self._entries[key] = _Entry(now + self.ttl, fingerprint)
+            self._sweep(now)
+            return entry, True
+
+    def complete(self, key, entry, response):
+        entry.response = response
+        with self._lock:
+            self._stats["stored"] += 1
+        entry.done.set()
+
+    def abandon(self, key, entry):
+        """Forget a key whose request failed, so the next retry runs again."""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+    def discard(self, key):
+        """Forget a completed key, e.g. after the state it answered for changed."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def wait(self, entry, timeout):
+        """The owner's response, or None if it failed or did not finish in time."""
+        entry.done.wait(timeout)
+        return entry.response
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["ttl"] = self.ttl
+        stats["max_entries"] = self.max_entries
+        return stats
@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """Run ``fn()`` every ``interval`` seconds on a background thread.
+
+    With a ``leader_lock`` (a FileWriteLock on a per-job file) only one
+    process runs the job: the first worker to take the lock keeps it until
+    it stops or exits (the kernel releases it then), and the others try it
+    without blocking each interval and skip the round while it is held.
+    The thread is restarted in a forked child if it was running in the
+    parent.
+    """
+
+    def __init__(self, name, interval, fn, leader_lock=None):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.leader_lock = leader_lock
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader = False
+        self._stats = {
+            "runs": 0,
+            "skipped_not_leader": 0,
+            "failures": 0,
+            "last_run": None,
+            "last_duration_seconds": None,
+            "last_result": None,
+        }
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        was_running = self._thread is not None
+        self._stop = threading.Event()
+        self._thread = None
+        # The lock file was reopened in the child; leadership stays with the parent.
+        self._leader = False
+        if was_running:
+            self.start()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=f"job-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        self._thread = None
+        if self._leader:
+            self.leader_lock.release()
+            self._leader = False
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Run one pass now if this process is the leader; returns fn's result."""
+        if self.leader_lock is not None and not self._leader:
+            if not self.leader_lock.try_acquire():
+                self._stats["skipped_not_leader"] += 1
+                return None
+            self._leader = True
+        started = time.monotonic()
+        try:
+            result = self.fn()
+            self._stats["last_result"] = result
+            return result
+        except Exception:
+            self._stats["failures"] += 1
+            log.exception("Job %s failed", self.name)
+            return None
+        finally:
+            self._stats["runs"] += 1
+            self._stats["last_run"] = time.time()
+            self._stats["last_duration_seconds"] = round(time.monotonic() - started, 3)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["interval"] = self.interval
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        stats["leader"] = self._leader
+        return stats
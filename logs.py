@@ -0,0 +1,144 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# Attributes every LogRecord has; anything else was passed via ``extra``.
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={...}`` keys become top-level fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Resolve the message and traceback now, but leave formatting (and
+        # any ``extra`` fields) to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """Pass the first of every ``every`` records per message template.
+
+    Errors and warnings always pass. Each emitted record carries ``sampled``
+    with the number of records it stands for.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            seen = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = seen + 1
+        if seen % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+class LogPipeline:
+    """Routes every logger through a queue to one background writer thread.
+
+    Request threads only put the record on a queue; formatting and the write
+    to stdout happen on the listener thread, so a slow log driver does not
+    show up in request latency.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.handler = _QueueHandler(self.queue)
+        self.output = logging.StreamHandler(sys.stdout)
+        self.listener = None
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, self.output, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def _reset_after_fork(self):
+        # The listener thread does not survive a fork; start a fresh one.
+        self.queue = queue.SimpleQueue()
+        self.handler.queue = self.queue
+        self.start()
+
+
+_pipeline = None
+
+
+def configure():
+    """Install the queue-backed JSON handler on the root logger, once.
+
+    LOG_LEVEL sets the default level, LOG_LEVELS overrides it per logger
+    (``db=DEBUG,werkzeug=WARNING``), LOG_FORMAT=text switches to plain lines
+    for local development, and LOG_SAMPLE_EVERY sets the sampling rate of
+    the high-frequency loggers returned by ``sampled_logger``.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return
+    _pipeline = LogPipeline()
+    if os.environ.get("LOG_FORMAT", "json") == "text":
+        _pipeline.output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        _pipeline.output.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [_pipeline.handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    for part in filter(None, os.environ.get("LOG_LEVELS", "").split(",")):
+        name, _, level = part.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _pipeline.start()
+    os.register_at_fork(after_in_child=_pipeline._reset_after_fork)
+
+
+def sampled_logger(name):
+    """Logger for per-request events that keeps 1 in LOG_SAMPLE_EVERY records."""
+    logger = logging.getLogger(name)
+    if not any(isinstance(f, SampleFilter) for f in logger.filters):
+        logger.addFilter(SampleFilter(int(os.environ.get("LOG_SAMPLE_EVERY", "100"))))
+    return logger
+
+
+def shutdown():
+    """Write out everything still queued."""
+    if _pipeline is not None:
+        _pipeline.stop()
@@ -1,55 +1,47 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request, jsonify, make_response
 from flask_cors import CORS
 import sqlite3
 import datetime
-import traceback
+import logging
 import os
+import atexit
+import base64
+import json
+import hashlib
+import functools
+import click
+import heapq
+import itertools
 import time
-import threading
-
-app = Flask(__name__)
+import csv
+import io
+import urllib.parse
+import zlib
+import logs
+import metrics
+from db import ConnectionPool, FileWriteLock, GroupCommitWriter
+from audit import AuditBuffer, AuditRetention, lower_id_bound, upper_id_bound
+from cache import TagCache
+from events import ChangeTail, EventBroker
+from jobs import PeriodicJob
+from roster import MissingRoster, attendance_version, query_missing
+from idempotency import IdempotencyCache
+from changes import CHANGE_ENTITIES, CHANGES_TABLE, ChangeRetention, change_triggers, feed_bounds, read_changes
 
+logs.configure()
+log = logging.getLogger(__name__)
+# Per-request events; sampled so bursts of taps don't flood the log.
+request_log = logs.sampled_logger(__name__ + ".requests")
+LOG_REQUEST_BODIES = os.environ.get("LOG_REQUEST_BODIES", "0") == "1"
 
-def get_db_connection(timeout=30.0, retries=3):
-    """Get a database connection with retry logic and prope@app.route("/stars/<star_id>", methods=["DELETE"])
-def delete_star(star_id):
-    try:
-        with db_lock:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("DELETE FROM stars WHERE id=?", (star_id,))
-            if c.rowcount == 0:
-                conn.close()
-                return jsonify({"status": "error", "message": "Star not found"}), 404
-            conn.commit()
-            conn.close()
-        
-        log_action("DELETE", "stars", f"Star {star_id} deleted")
-        return jsonify({"status": "ok"})
-    except Exception as e:
-        print(f"Error deleting star: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500ndling."""
-    for attempt in range(retries):
-        try:
-            conn = sqlite3.connect(DB_FILE, timeout=timeout)
-            conn.execute('PRAGMA journal_mode=WAL;')
-            conn.execute(f'PRAGMA busy_timeout={int(timeout * 1000)};')
-            return conn
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e).lower() and attempt < retries - 1:
-                print(f"Database locked, retrying in {0.1 * (attempt + 1)} seconds... (attempt {attempt + 1}/{retries})")
-                time.sleep(0.1 * (attempt + 1)) 
-                continue
-            raise e
-    raise sqlite3.OperationalError("Failed to get database connection after retries")
-
-db_lock = threading.Lock()
+app = Flask(__name__)
 
 cors = CORS(app, resources={
     r"/*": {
         "origins": "*", 
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization", "Accept"]
+        "allow_headers": ["Content-Type", "Authorization", "Accept", "If-None-Match", "Idempotency-Key"],
+        "expose_headers": ["ETag", "Idempotent-Replayed"]
     }
 })
 
@@ -57,10 +49,124 @@ cors = CORS(app, resources={
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, If-None-Match, Idempotency-Key'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag, Idempotent-Replayed'
     return response
 
-DB_FILE = "daydream_sydney.db"
+DB_FILE = os.environ.get("DB_FILE", "daydream_sydney.db")
+
+# Tables whose writes bump a counter in table_versions, used for ETags.
+VERSIONED_TABLES = ("users", "stars", "nfc_tags", "attendance", "audit_logs")
+
+pool = ConnectionPool(DB_FILE)
+writer = GroupCommitWriter(
+    pool,
+    max_batch=int(os.environ.get("WRITER_BATCH_SIZE", "64")),
+    max_delay=float(os.environ.get("WRITER_BATCH_MS", "2")) / 1000.0,
+    write_lock=FileWriteLock(DB_FILE + ".write.lock"),
+    timeout=float(os.environ.get("WRITER_TIMEOUT", "30")),
+)
+audit_buffer = AuditBuffer(
+    writer,
+    capacity=int(os.environ.get("AUDIT_BUFFER_SIZE", "10000")),
+    flush_size=int(os.environ.get("AUDIT_FLUSH_SIZE", "200")),
+    flush_interval=float(os.environ.get("AUDIT_FLUSH_INTERVAL", "1.0")),
+)
+# How far audit ids can lag their timestamps; see audit.lower_id_bound.
+AUDIT_TIMESTAMP_SKEW = float(os.environ.get("AUDIT_TIMESTAMP_SKEW", "120"))
+audit_retention = AuditRetention(
+    pool,
+    writer,
+    archive_dir=os.environ.get("AUDIT_ARCHIVE_DIR", DB_FILE + ".audit-archive"),
+    max_age_days=float(os.environ.get("AUDIT_RETENTION_DAYS", "90")),
+    max_rows=int(os.environ.get("AUDIT_RETENTION_ROWS", "0")),
+    batch_size=int(os.environ.get("AUDIT_RETENTION_BATCH", "5000")),
+    timestamp_skew=AUDIT_TIMESTAMP_SKEW,
+)
+change_retention = ChangeRetention(
+    pool,
+    writer,
+    max_age_days=float(os.environ.get("CHANGES_RETENTION_DAYS", "30")),
+    batch_size=int(os.environ.get("CHANGES_RETENTION_BATCH", "5000")),
+)
+tag_cache = TagCache(
+    max_size=int(os.environ.get("NFC_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("NFC_CACHE_TTL", "300")),
+    resync_interval=float(os.environ.get("NFC_CACHE_RESYNC_SECONDS", "1")),
+)
+TAG_CACHE_TABLES = ("nfc_tags", "users")
+# Each open stream holds a server thread, so by default at most half of a
+# worker's threads can go to live displays; asgi.py serves streams without
+# threads and is the mode to use for many of them.
+attendance_events = EventBroker(
+    history=int(os.environ.get("ATTENDANCE_EVENT_HISTORY", "1000")),
+    max_subscribers=int(os.environ.get("SSE_MAX_SUBSCRIBERS", max(1, int(os.environ.get("WEB_THREADS", "8")) // 2))),
+)
+# Streams follow the change feed, so they see taps committed by any worker.
+attendance_tail = ChangeTail(attendance_events, pool, "attendance", "attendance",
+                             interval=float(os.environ.get("SSE_POLL_SECONDS", "0.5")))
+# Responses replayed for retried requests: by Idempotency-Key header, or by
+# request content inside a short debounce window for readers that send none.
+idempotency_keys = IdempotencyCache(
+    ttl=float(os.environ.get("IDEMPOTENCY_TTL", "86400")),
+    max_entries=int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+)
+tap_debounce = IdempotencyCache(
+    ttl=float(os.environ.get("TAP_DEBOUNCE_SECONDS", "2")),
+    max_entries=int(os.environ.get("TAP_DEBOUNCE_MAX_ENTRIES", "10000")),
+)
+missing_roster = MissingRoster(resync_interval=float(os.environ.get("ROSTER_RESYNC_SECONDS", "5")))
+
+# Background jobs start in every serving process; the first to take a job's
+# leader lock runs it for as long as it lives, the others stand by.
+background_jobs = [
+    PeriodicJob("audit-retention", float(os.environ.get("AUDIT_RETENTION_INTERVAL", "300")),
+                audit_retention.run_once, leader_lock=FileWriteLock(DB_FILE + ".audit-retention.lock")),
+    PeriodicJob("close-day", float(os.environ.get("CLOSE_DAY_INTERVAL", "3600")),
+                lambda: close_recent_days(), leader_lock=FileWriteLock(DB_FILE + ".close-day.lock")),
+    PeriodicJob("changes-retention", float(os.environ.get("CHANGES_RETENTION_INTERVAL", "3600")),
+                change_retention.run_once, leader_lock=FileWriteLock(DB_FILE + ".changes-retention.lock")),
+]
+
+# With several workers, /metrics sums every worker's values through files in
+# METRICS_DIR (set by gunicorn.conf.py); each worker refreshes its own file.
+if os.environ.get("METRICS_DIR"):
+    metrics.REGISTRY.enable_multiprocess(os.environ["METRICS_DIR"])
+    background_jobs.append(PeriodicJob("metrics-snapshot", float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", "5")),
+                                       metrics.REGISTRY.write_snapshot))
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "http_request_duration_seconds", "Request latency by route, up to the first response byte.",
+    ("method", "route", "status"))
+metrics.REGISTRY.gauge("sqlite_pool_connections", "Pooled connections by state.",
+                       lambda: {(k,): pool.stats()[k] for k in ("in_use", "idle")}, ("state",))
+metrics.REGISTRY.gauge("db_write_queue_depth", "Write ops waiting for the writer thread.",
+                       lambda: writer.stats()["queued"])
+metrics.REGISTRY.gauge("audit_buffer_rows", "Audit rows buffered in memory.",
+                       lambda: audit_buffer.stats()["buffered"])
+metrics.REGISTRY.gauge("audit_buffer_dropped_total", "Audit rows dropped because the buffer was full.",
+                       lambda: audit_buffer.stats()["dropped"], kind="counter")
+metrics.REGISTRY.gauge("duplicate_requests_suppressed_total", "Retried requests answered from memory.",
+                       lambda: {(name, reason): cache.stats()[reason]
+                                for name, cache in (("idempotency_key", idempotency_keys), ("debounce", tap_debounce))
+                                for reason in ("replayed", "joined_in_flight")},
+                       ("layer", "reason"), kind="counter")
+metrics.REGISTRY.gauge("nfc_cache_entries", "Entries in the NFC tag cache.",
+                       lambda: tag_cache.stats()["size"])
+metrics.REGISTRY.gauge("nfc_cache_lookups_total", "NFC tag cache lookups by result.",
+                       lambda: {(k,): tag_cache.stats()[k] for k in ("hits", "misses")}, ("result",), kind="counter")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
 
 @app.errorhandler(404)
 def not_found(error):
@@ -72,13 +178,11 @@ def server_error(error):
 
 @app.errorhandler(Exception)
 def handle_exception(e):
-    print(f"Unhandled exception: {e}")
-    print(traceback.format_exc())
+    log.exception("Unhandled exception in %s %s", request.method, request.path)
     return jsonify({"status": "error", "message": "An unexpected error occurred"}), 500
 
 def init_db():
-    with db_lock:
-        conn = get_db_connection()
+    with pool.connection() as conn:
         c = conn.cursor()
 
         c.execute('''
@@ -162,35 +266,407 @@ def init_db():
         c.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_stars_user_created ON stars(user_id, created_at)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_nfc_tags_user ON nfc_tags(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_attendance_tag_date ON attendance(tag_id, date)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date)')
+        # UNIQUE(tag_id, date) already provides the (tag_id, date) index.
+        c.execute('DROP INDEX IF EXISTS idx_attendance_tag_date')
+        c.execute('DROP INDEX IF EXISTS idx_attendance_user_date')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_attendance_user_date_created ON attendance(user_id, date, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_attendance_date_created ON attendance(date, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_audit_logs_action ON audit_logs(action, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_audit_logs_table ON audit_logs(table_name, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs(timestamp)')
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='attendance_daily'")
+        rollups_exist = c.fetchone() is not None
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attendance_daily (
+                date TEXT PRIMARY KEY,
+                present INTEGER NOT NULL DEFAULT 0,
+                absent INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attendance_user_monthly (
+                user_id TEXT NOT NULL,
+                month TEXT NOT NULL,
+                present INTEGER NOT NULL DEFAULT 0,
+                absent INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, month)
+            ) WITHOUT ROWID
+        ''')
+
+        # Rollups are maintained row by row in the same transaction as the
+        # attendance write, whichever code path performs it.
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_rollup_insert
+            AFTER INSERT ON attendance
+            BEGIN
+                INSERT INTO attendance_daily (date, present, absent)
+                VALUES (NEW.date, NEW.status = 'present', NEW.status = 'absent')
+                ON CONFLICT(date) DO UPDATE SET
+                    present = present + excluded.present, absent = absent + excluded.absent;
+                INSERT INTO attendance_user_monthly (user_id, month, present, absent)
+                SELECT NEW.user_id, substr(NEW.date, 1, 7), NEW.status = 'present', NEW.status = 'absent'
+                WHERE NEW.user_id IS NOT NULL
+                ON CONFLICT(user_id, month) DO UPDATE SET
+                    present = present + excluded.present, absent = absent + excluded.absent;
+            END;
+        ''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_rollup_delete
+            AFTER DELETE ON attendance
+            BEGIN
+                UPDATE attendance_daily SET
+                    present = present - (OLD.status = 'present'), absent = absent - (OLD.status = 'absent')
+                WHERE date = OLD.date;
+                UPDATE attendance_user_monthly SET
+                    present = present - (OLD.status = 'present'), absent = absent - (OLD.status = 'absent')
+                WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7);
+            END;
+        ''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_rollup_update
+            AFTER UPDATE OF status, date, user_id ON attendance
+            BEGIN
+                UPDATE attendance_daily SET
+                    present = present - (OLD.status = 'present'), absent = absent - (OLD.status = 'absent')
+                WHERE date = OLD.date;
+                UPDATE attendance_user_monthly SET
+                    present = present - (OLD.status = 'present'), absent = absent - (OLD.status = 'absent')
+                WHERE user_id = OLD.user_id AND month = substr(OLD.date, 1, 7);
+                INSERT INTO attendance_daily (date, present, absent)
+                VALUES (NEW.date, NEW.status = 'present', NEW.status = 'absent')
+                ON CONFLICT(date) DO UPDATE SET
+                    present = present + excluded.present, absent = absent + excluded.absent;
+                INSERT INTO attendance_user_monthly (user_id, month, present, absent)
+                SELECT NEW.user_id, substr(NEW.date, 1, 7), NEW.status = 'present', NEW.status = 'absent'
+                WHERE NEW.user_id IS NOT NULL
+                ON CONFLICT(user_id, month) DO UPDATE SET
+                    present = present + excluded.present, absent = absent + excluded.absent;
+            END;
+        ''')
+
+        if not rollups_exist:
+            rebuild_attendance_rollups(conn)
+
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='star_counts'")
+        star_counts_exist = c.fetchone() is not None
+
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS star_counts (
+                user_id TEXT PRIMARY KEY,
+                star_count INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_star_counts_rank ON star_counts(star_count DESC, user_id)')
+
+        # Like the attendance rollups, counts change in the same transaction
+        # as the star write. Users with no stars have no row.
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stars_count_insert
+            AFTER INSERT ON stars
+            BEGIN
+                INSERT INTO star_counts (user_id, star_count) VALUES (NEW.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET star_count = star_count + 1;
+            END;
+        ''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stars_count_delete
+            AFTER DELETE ON stars
+            BEGIN
+                UPDATE star_counts SET star_count = star_count - 1 WHERE user_id = OLD.user_id;
+                DELETE FROM star_counts WHERE user_id = OLD.user_id AND star_count <= 0;
+            END;
+        ''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stars_count_update
+            AFTER UPDATE OF user_id ON stars
+            BEGIN
+                UPDATE star_counts SET star_count = star_count - 1 WHERE user_id = OLD.user_id;
+                DELETE FROM star_counts WHERE user_id = OLD.user_id AND star_count <= 0;
+                INSERT INTO star_counts (user_id, star_count) VALUES (NEW.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET star_count = star_count + 1;
+            END;
+        ''')
+
+        if not star_counts_exist:
+            rebuild_star_counts(conn)
+
+        for table in VERSIONED_TABLES:
+            c.execute("INSERT OR IGNORE INTO table_versions (table_name) VALUES (?)", (table,))
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                c.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+                    END;
+                ''')
+
+        # Structured change log for incremental sync, written by triggers in
+        # the same transaction as the mutation it describes.
+        c.execute(CHANGES_TABLE)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_changes_entity ON changes(entity, seq)')
+        for _, sql in change_triggers():
+            c.execute(sql)
 
         conn.commit()
-        conn.close()
+
+def rebuild_attendance_rollups(conn):
+    """Recompute the attendance rollup tables from scratch."""
+    conn.execute("DELETE FROM attendance_daily")
+    conn.execute("DELETE FROM attendance_user_monthly")
+    conn.execute("""
+        INSERT INTO attendance_daily (date, present, absent)
+        SELECT date, SUM(status = 'present'), SUM(status = 'absent')
+        FROM attendance GROUP BY date
+    """)
+    conn.execute("""
+        INSERT INTO attendance_user_monthly (user_id, month, present, absent)
+        SELECT user_id, substr(date, 1, 7), SUM(status = 'present'), SUM(status = 'absent')
+        FROM attendance WHERE user_id IS NOT NULL GROUP BY user_id, substr(date, 1, 7)
+    """)
+    # The summary and stats ETags follow the attendance version; make repaired rollups visible.
+    conn.execute("UPDATE table_versions SET version = version + 1 WHERE table_name = 'attendance'")
+
+def rebuild_star_counts(conn):
+    """Recompute star_counts from the stars table; returns the number of users counted."""
+    conn.execute("DELETE FROM star_counts")
+    users = conn.execute("""
+        INSERT INTO star_counts (user_id, star_count)
+        SELECT user_id, COUNT(*) FROM stars GROUP BY user_id
+    """).rowcount
+    # The leaderboard's ETag follows the stars version; make repaired counts visible.
+    conn.execute("UPDATE table_versions SET version = version + 1 WHERE table_name = 'stars'")
+    return users
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute attendance rollups from the attendance table."""
+    writer.run(rebuild_attendance_rollups, timeout=None)
+    log.info("Attendance rollups rebuilt")
+
+@app.cli.command("rebuild-star-counts")
+def rebuild_star_counts_command():
+    """Recompute per-user star counts from the stars table."""
+    users = writer.run(rebuild_star_counts, timeout=None)
+    log.info("Star counts rebuilt for %d users", users)
+
+@app.cli.command("prune-audit")
+def prune_audit_command():
+    """Archive and delete audit rows outside the retention policy, then vacuum."""
+    total = {"deleted": 0, "pages_freed": 0}
+    while True:
+        result = audit_retention.run_once()
+        total = {k: total[k] + result[k] for k in total}
+        if not result["deleted"] and not result["pages_freed"]:
+            break
+    audit_buffer.stop()
+    log.info("Audit retention: %d rows deleted, %d pages freed", total["deleted"], total["pages_freed"])
+
+@app.cli.command("close-day")
+@click.option("--from", "date_from", help="First date to close (default: yesterday).")
+@click.option("--to", "date_to", help="Last date to close (default: --from).")
+def close_day_command(date_from, date_to):
+    """Record 'absent' for every linked tag with no attendance on each date."""
+    date_from = date_from or (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    try:
+        closed = close_days(date_from, date_to or date_from)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    audit_buffer.stop()
+    for date, inserted in closed.items():
+        log.info("Closed %s: %d absences recorded", date, inserted)
+
+@app.cli.command("enable-incremental-vacuum")
+def enable_incremental_vacuum_command():
+    """Switch an existing database to auto_vacuum=INCREMENTAL (rewrites the file; stop the server first)."""
+    with pool.connection() as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    log.info("auto_vacuum set to INCREMENTAL")
+
+def read_table_versions(conn, tables):
+    placeholders = ",".join("?" * len(tables))
+    rows = conn.execute(f"SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})",
+                        tables).fetchall()
+    return sorted(rows)
+
+def conditional(*tables):
+    """Serve a GET view with an ETag derived from the change versions of ``tables``.
+
+    A request whose If-None-Match matches gets a 304 after a single primary
+    key lookup on table_versions, without running the view's query.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with pool.connection() as conn:
+                versions = read_table_versions(conn, tables)
+            key = f"{request.full_path}|{datetime.date.today().isoformat()}|{versions}"
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", "30"))
+
+def body_fingerprint(body):
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+def idempotent(debounce_key):
+    """Answer retried POSTs with the original response, without touching SQLite.
+
+    Requests carrying an ``Idempotency-Key`` header are keyed on it for
+    IDEMPOTENCY_TTL seconds, and reusing a key with a different body is
+    rejected with 422; other requests are keyed on
+    ``debounce_key(body)`` for TAP_DEBOUNCE_SECONDS and are only repeats
+    when the whole body matches, so a different request for the same key
+    runs and replaces the remembered one. A duplicate that arrives while
+    the first is still running waits for its response. Failed requests
+    (5xx) are not remembered, and debounced requests only remember
+    successes.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            header = request.headers.get("Idempotency-Key")
+            body = request.get_json(silent=True)
+            if header:
+                cache, key = idempotency_keys, (request.method, request.path, header)
+                fingerprint = body_fingerprint(body if body is not None else request.get_data(as_text=True))
+            else:
+                parts = debounce_key(body) if isinstance(body, dict) else None
+                # Malformed fields are left for the view to reject.
+                if parts is None or not all(isinstance(part, str) for part in parts):
+                    return view(*args, **kwargs)
+                cache, key = tap_debounce, (request.method, request.path) + parts
+                fingerprint = body_fingerprint(body)
+
+            entry, owner = cache.begin(key, fingerprint, replace=cache is tap_debounce)
+            if not owner and entry.fingerprint != fingerprint:
+                error_msg = "Idempotency-Key was already used with a different request body"
+                request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+                return jsonify({"status": "error", "message": error_msg}), 422
+            if not owner:
+                stored = cache.wait(entry, IDEMPOTENCY_WAIT_SECONDS)
+                if stored is None:
+                    return view(*args, **kwargs)
+                body, status, mimetype = stored
+                return app.response_class(body, status=status, mimetype=mimetype,
+                                          headers={"Idempotent-Replayed": "true"})
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                cache.abandon(key, entry)
+                raise
+            keep = response.status_code < 300 if cache is tap_debounce else response.status_code < 500
+            if keep and not response.is_streamed:
+                cache.complete(key, entry, (response.get_data(), response.status_code, response.mimetype))
+            else:
+                cache.abandon(key, entry)
+            return response
+        return wrapper
+    return decorator
+
+def parse_limit(default=100, maximum=1000):
+    """Read the ``limit`` query parameter, clamped to ``maximum``."""
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, maximum)
+
+def parse_id_param(name):
+    """Read an integer query parameter, or None if absent."""
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+
+def parse_timestamp_param(name):
+    """Read an ISO 8601 query parameter in the form audit timestamps are stored.
+
+    Audit rows hold naive UTC ``isoformat()`` strings and are compared as
+    text, so ``2026-10-17 10:00`` and ``2026-10-17T12:00+02:00`` both
+    become ``2026-10-17T10:00:00``.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 timestamp") from None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat()
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(token, *types):
+    """Decode an ``after`` token produced by encode_cursor, or None if absent.
+
+    ``types`` is the endpoint's cursor shape, one type per value; a token of
+    any other shape (e.g. one issued by a different listing) is rejected.
+    """
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if (not isinstance(values, list) or len(values) != len(types)
+            or any(type(value) is not kind for value, kind in zip(values, types))):
+        raise ValueError("Invalid cursor")
+    return values
 
 def log_action(action, table, details=""):
-    """Thread-safe logging function that uses the same connection when possible."""
+    """Buffer an audit row; the background flusher writes it in the next batch."""
     try:
-        with db_lock:
-            conn = get_db_connection(timeout=10.0)
-            c = conn.cursor()
-            c.execute("INSERT INTO audit_logs (action, table_name, details, timestamp) VALUES (?, ?, ?, ?)",
-                      (action, table, details, datetime.datetime.utcnow().isoformat()))
-            conn.commit()
-            conn.close()
+        audit_buffer.append(action, table, details)
     except Exception as e:
-        print(f"Warning: Failed to log action {action} on {table}: {e}")
+        log.warning("Failed to log action %s on %s: %s", action, table, e)
+
+def log_request_body(data):
+    """Request bodies can hold personal details; only logged with LOG_REQUEST_BODIES=1."""
+    if LOG_REQUEST_BODIES:
+        log.info("Request body for %s %s: %s", request.method, request.path, json.dumps(data))
 
 def populate_sample_data():
-    with db_lock:
-        conn = get_db_connection()
+    with pool.connection() as conn:
         c = conn.cursor()
         
         c.execute("SELECT COUNT(*) FROM users")
         user_count = c.fetchone()[0]
         
         if user_count == 0:
-            print("Adding sample users...")
+            log.info("Adding sample users")
             sample_user_id = "8472A92D-C6D5-4014-82FE-9D47348DAE24" 
             c.execute("INSERT INTO users (id, name, email) VALUES (?, ?, ?)",
                       (sample_user_id, "Sample User", "sample@example.com"))
@@ -204,70 +680,107 @@ def populate_sample_data():
                       ("04BC777A7B1190", sample_user_id))  
             
             conn.commit()
-            print("Sample data added successfully")
-        
-        conn.close()
+            log.info("Sample data added")
+
+def start_background_jobs():
+    """Start the periodic jobs in this process unless BACKGROUND_JOBS=0."""
+    if os.environ.get("BACKGROUND_JOBS", "1") == "0":
+        return
+    for job in background_jobs:
+        job.start()
+
+def shutdown():
+    """Stop background jobs, flush buffered audit rows, drain the writer and close pooled connections."""
+    for job in background_jobs:
+        job.stop()
+    attendance_tail.stop()
+    audit_buffer.stop()
+    writer.stop()
+    pool.close_all()
+    metrics.REGISTRY.write_snapshot()
+    logs.shutdown()
+
+atexit.register(shutdown)
 
 init_db()
-populate_sample_data()
+if os.environ.get("SAMPLE_DATA", "1") != "0":
+    populate_sample_data()
+# Under a pre-forking server this module is imported once in the master;
+# close the startup connections so every worker opens its own after the fork.
+pool.close_all()
 
 @app.route("/users", methods=["POST"])
 def create_user():
     data = request.json
     try:
-        print(f"Create user request received: {data}")
+        log_request_body(data)
         
         required_fields = ["id", "name", "email"]
         for field in required_fields:
             if field not in data:
                 error_msg = f"Missing required field: {field}"
-                print(error_msg)
+                request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
                 return jsonify({"status": "error", "message": error_msg}), 400
         
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        
-        c.execute("SELECT id FROM users WHERE email=?", (data["email"],))
-        existing_user = c.fetchone()
-        if existing_user:
-            conn.close()
+        def insert_user(conn):
+            c = conn.cursor()
+
+            c.execute("SELECT id FROM users WHERE email=?", (data["email"],))
+            if c.fetchone():
+                return None
+
+            c.execute("INSERT INTO users (id, name, email) VALUES (?, ?, ?)",
+                      (data["id"], data["name"], data["email"]))
+
+            c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (data["id"],))
+            return c.fetchone()
+
+        user = writer.run(insert_user)
+        if user is None:
             error_msg = f"Email already exists: {data['email']}"
-            print(error_msg)
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
-        
-        c.execute("INSERT INTO users (id, name, email) VALUES (?, ?, ?)",
-                  (data["id"], data["name"], data["email"]))
-        conn.commit()
-        
-        c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (data["id"],))
-        user = c.fetchone()
-        conn.close()
-        
+
         log_action("INSERT", "users", f"User {data['id']} created")
-        print(f"User created successfully: {data['id']}")
+        request_log.info("User %s created", data["id"])
         
         return jsonify({"id": user[0], "name": user[1], "email": user[2], 
                         "created_at": user[3], "updated_at": user[4]}), 201
     except Exception as e:
-        print(f"Error creating user: {str(e)}")
+        log.warning("Error creating user: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 400
 
 @app.route("/users", methods=["GET"])
+@conditional("users")
 def list_users():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, name, email, created_at, updated_at FROM users")
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([{"id": r[0], "name": r[1], "email": r[2], "created_at": r[3], "updated_at": r[4]} for r in rows])
+    """List users ordered by id, one keyset page at a time."""
+    try:
+        limit = parse_limit()
+        after = decode_cursor(request.args.get("after"), str)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        if after:
+            c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                      (after[0], limit))
+        else:
+            c.execute("SELECT id, name, email, created_at, updated_at FROM users ORDER BY id LIMIT ?", (limit,))
+        rows = c.fetchall()
+
+    next_cursor = encode_cursor([rows[-1][0]]) if len(rows) == limit else None
+    return jsonify({
+        "items": [{"id": r[0], "name": r[1], "email": r[2], "created_at": r[3], "updated_at": r[4]} for r in rows],
+        "next": next_cursor
+    })
 
 @app.route("/users/<user_id>", methods=["GET"])
 def get_user(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (user_id,))
+        row = c.fetchone()
     if not row:
         return jsonify({"status": "error", "message": "User not found"}), 404
     return jsonify({"id": row[0], "name": row[1], "email": row[2], "created_at": row[3], "updated_at": row[4]})
@@ -276,83 +789,111 @@ def get_user(user_id):
 def update_user(user_id):
     data = request.json
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("UPDATE users SET name=?, email=? WHERE id=?", 
-                 (data["name"], data["email"], user_id))
-        if c.rowcount == 0:
-            conn.close()
+        def update(conn):
+            c = conn.cursor()
+            c.execute("UPDATE users SET name=?, email=? WHERE id=?",
+                     (data["name"], data["email"], user_id))
+            if c.rowcount == 0:
+                return None
+            c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (user_id,))
+            return c.fetchone()
+
+        row = writer.run(update)
+        if row is None:
             return jsonify({"status": "error", "message": "User not found"}), 404
-        conn.commit()
-        
-        c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (user_id,))
-        row = c.fetchone()
-        conn.close()
-        
+
+        tag_cache.invalidate_user(user_id)
+        missing_roster.invalidate()
         log_action("UPDATE", "users", f"User {user_id} updated")
         return jsonify({"id": row[0], "name": row[1], "email": row[2], "created_at": row[3], "updated_at": row[4]})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
 @app.route("/stars", methods=["POST"])
+@idempotent(lambda body: (body.get("id"), body.get("user_id")) if body.get("id") else None)
 def create_star():
     data = request.json
     try:
-        print(f"Creating star: {data}")
+        log_request_body(data)
         
         if not data or "id" not in data or "user_id" not in data:
             error_msg = "Missing required fields: id and user_id"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
         
         star_id = data["id"]
         user_id = data["user_id"]
+        if not isinstance(star_id, str) or not isinstance(user_id, str):
+            error_msg = "Fields id and user_id must be strings"
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+            return jsonify({"status": "error", "message": error_msg}), 400
         
-        with db_lock:
-            conn = get_db_connection()
+        def insert_star(conn):
             c = conn.cursor()
-            
+
             c.execute("SELECT id FROM users WHERE id=?", (user_id,))
             if not c.fetchone():
-                conn.close()
-                error_msg = f"User not found: {user_id}"
-                print(f"Error: {error_msg}")
-                return jsonify({"status": "error", "message": error_msg}), 400
-            
+                return "no_user"
+
             c.execute("SELECT id FROM stars WHERE id=?", (star_id,))
             if c.fetchone():
-                conn.close()
-                print(f"Star {star_id} already exists")
-                return jsonify({"status": "ok", "message": "Star already exists"}), 200
-            
+                return "exists"
+
             c.execute("INSERT INTO stars (id, user_id) VALUES (?, ?)", (star_id, user_id))
-            conn.commit()
-            conn.close()
-            
+            return "created"
+
+        outcome = writer.run(insert_star)
+        if outcome == "no_user":
+            error_msg = f"User not found: {user_id}"
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+            return jsonify({"status": "error", "message": error_msg}), 400
+        if outcome == "exists":
+            request_log.info("Star %s already exists", star_id)
+            return jsonify({"status": "ok", "message": "Star already exists"}), 200
+
         log_action("INSERT", "stars", f"Star {star_id} for user {user_id}")
-        print(f"Successfully created star {star_id} for user {user_id}")
+        request_log.info("Created star %s for user %s", star_id, user_id)
         return jsonify({"status": "ok"}), 201
         
     except sqlite3.IntegrityError as e:
         error_msg = f"Database constraint violation: {str(e)}"
-        print(f"Error: {error_msg}")
+        request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
         return jsonify({"status": "error", "message": error_msg}), 400
     except Exception as e:
         error_msg = f"Unexpected error creating star: {str(e)}"
-        print(f"Error: {error_msg}")
+        request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
         return jsonify({"status": "error", "message": error_msg}), 500
 
 @app.route("/users/<user_id>/stars", methods=["GET"])
 def list_user_stars(user_id):
+    """List a user's stars oldest first, paged along idx_stars_user_created."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT id, user_id, created_at FROM stars WHERE user_id=?", (user_id,))
-        rows = c.fetchall()
-        conn.close()
-        return jsonify([{"id": r[0], "user_id": r[1], "created_at": r[2]} for r in rows])
+        limit = parse_limit()
+        after = decode_cursor(request.args.get("after"), str, int)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            c = conn.cursor()
+            if after:
+                c.execute("""
+                    SELECT id, user_id, created_at, rowid FROM stars
+                    WHERE user_id=? AND (created_at, rowid) > (?, ?)
+                    ORDER BY created_at, rowid LIMIT ?
+                """, (user_id, after[0], after[1], limit))
+            else:
+                c.execute("SELECT id, user_id, created_at, rowid FROM stars WHERE user_id=? ORDER BY created_at, rowid LIMIT ?",
+                          (user_id, limit))
+            rows = c.fetchall()
+
+        next_cursor = encode_cursor([rows[-1][2], rows[-1][3]]) if len(rows) == limit else None
+        return jsonify({
+            "items": [{"id": r[0], "user_id": r[1], "created_at": r[2]} for r in rows],
+            "next": next_cursor
+        })
     except Exception as e:
-        print(f"Error listing user stars: {e}")
+        log.warning("Error listing user stars: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route("/stars/<user_id>", methods=["GET"])
@@ -361,118 +902,161 @@ def list_stars(user_id):
 
 @app.route("/stars/<star_id>", methods=["DELETE"])
 def delete_star(star_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM stars WHERE id=?", (star_id,))
-    if c.rowcount == 0:
-        conn.close()
+    deleted = writer.run(lambda conn: conn.execute("DELETE FROM stars WHERE id=?", (star_id,)).rowcount)
+    if deleted == 0:
         return jsonify({"status": "error", "message": "Star not found"}), 404
-    conn.commit()
-    conn.close()
     log_action("DELETE", "stars", f"Star {star_id} deleted")
     return jsonify({"status": "ok"})
 
 @app.route("/stars/<star_id>", methods=["GET"])
 def get_star(star_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT id, user_id, created_at FROM stars WHERE id=?", (star_id,))
-        row = c.fetchone()
-        conn.close()
+        with pool.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id, user_id, created_at FROM stars WHERE id=?", (star_id,))
+            row = c.fetchone()
         if not row:
             return jsonify({"status": "error", "message": "Star not found"}), 404
         return jsonify({"id": row[0], "user_id": row[1], "created_at": row[2]})
     except Exception as e:
-        print(f"Error getting star: {e}")
+        log.warning("Error getting star: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route("/stars/leaderboard", methods=["GET"])
+@conditional("stars", "users")
+def star_leaderboard():
+    """Users with the most stars, read in order from idx_star_counts_rank."""
+    try:
+        limit = parse_limit(default=10, maximum=100)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        rows = conn.execute("""
+            SELECT s.user_id, u.name, s.star_count
+            FROM star_counts s
+            JOIN users u ON u.id = s.user_id
+            ORDER BY s.star_count DESC, s.user_id
+            LIMIT ?
+        """, (limit,)).fetchall()
+    return jsonify({"items": [{"rank": i + 1, "user_id": r[0], "name": r[1], "star_count": r[2]}
+                              for i, r in enumerate(rows)]})
+
+@app.route("/users/<user_id>/stars/count", methods=["GET"])
+def user_star_count(user_id):
+    with pool.connection() as conn:
+        row = conn.execute("""
+            SELECT u.id, COALESCE(s.star_count, 0)
+            FROM users u
+            LEFT JOIN star_counts s ON s.user_id = u.id
+            WHERE u.id=?
+        """, (user_id,)).fetchone()
+    if not row:
+        return jsonify({"status": "error", "message": "User not found"}), 404
+    return jsonify({"user_id": row[0], "star_count": row[1]})
+
+@app.route("/admin/star-counts/rebuild", methods=["POST"])
+def rebuild_star_counts_admin():
+    """Recompute star counts from scratch, e.g. after restoring stars from a backup."""
+    users = writer.run(rebuild_star_counts)
+    return jsonify({"status": "ok", "users": users})
+
 @app.route("/users/<user_id>/stars", methods=["DELETE"])
 def delete_user_stars(user_id):
     try:
-        with db_lock:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("DELETE FROM stars WHERE user_id=?", (user_id,))
-            deleted_count = c.rowcount
-            conn.commit()
-            conn.close()
+        deleted_count = writer.run(
+            lambda conn: conn.execute("DELETE FROM stars WHERE user_id=?", (user_id,)).rowcount)
         
         log_action("DELETE", "stars", f"{deleted_count} stars deleted for user {user_id}")
         return jsonify({"status": "ok", "deleted": deleted_count})
     except Exception as e:
-        print(f"Error deleting user stars: {e}")
+        log.warning("Error deleting user stars: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route("/nfc", methods=["POST"])
 def create_nfc():
     data = request.json
     try:
-        print(f"NFC link request received: {data}")
+        log_request_body(data)
         
         if not data:
             error_msg = "No JSON data provided"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
         
         if "tag_id" not in data or not data["tag_id"]:
             error_msg = "Missing or empty tag_id field"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
             
         if "user_id" not in data or not data["user_id"]:
             error_msg = "Missing or empty user_id field"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
         
         tag_id = data["tag_id"]
         user_id = data["user_id"]
         
-        print(f"Attempting to link tag '{tag_id}' to user '{user_id}'")
-        
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        
-        c.execute("SELECT id FROM users WHERE id=?", (user_id,))
-        if not c.fetchone():
-            conn.close()
+        def link_tag(conn):
+            c = conn.cursor()
+
+            c.execute("SELECT id FROM users WHERE id=?", (user_id,))
+            if not c.fetchone():
+                return "no_user"
+
+            c.execute("SELECT user_id FROM nfc_tags WHERE tag_id=?", (tag_id,))
+            existing_link = c.fetchone()
+            if existing_link:
+                return "linked" if existing_link[0] == user_id else "taken"
+
+            c.execute("INSERT INTO nfc_tags (tag_id, user_id) VALUES (?, ?)", (tag_id, user_id))
+            return "created"
+
+        outcome = writer.run(link_tag)
+        if outcome == "no_user":
             error_msg = f"User not found: {user_id}"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
-        
-        c.execute("SELECT user_id FROM nfc_tags WHERE tag_id=?", (tag_id,))
-        existing_link = c.fetchone()
-        if existing_link:
-            if existing_link[0] == user_id:
-                conn.close()
-                print(f"Tag {tag_id} is already linked to user {user_id}")
-                return jsonify({"status": "ok", "message": "Tag already linked to this user"}), 200
-            else:
-                conn.close()
-                error_msg = f"Tag {tag_id} is already linked to another user"
-                print(f"Error: {error_msg}")
-                return jsonify({"status": "error", "message": error_msg}), 400
-        
-        c.execute("INSERT INTO nfc_tags (tag_id, user_id) VALUES (?, ?)", (tag_id, user_id))
-        conn.commit()
-        conn.close()
-        
+        if outcome == "linked":
+            request_log.info("Tag %s is already linked to user %s", tag_id, user_id)
+            return jsonify({"status": "ok", "message": "Tag already linked to this user"}), 200
+        if outcome == "taken":
+            error_msg = f"Tag {tag_id} is already linked to another user"
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+            return jsonify({"status": "error", "message": error_msg}), 400
+
+        tag_cache.invalidate_tag(tag_id)
+        missing_roster.invalidate()
         log_action("INSERT", "nfc_tags", f"Tag {tag_id} for user {user_id}")
-        print(f"Successfully linked tag {tag_id} to user {user_id}")
+        request_log.info("Linked tag %s to user %s", tag_id, user_id)
         return jsonify({"status": "ok"}), 201
     except Exception as e:
-        print(f"Error linking NFC tag: {str(e)}")
-        print(f"Request data was: {data}")
+        log.warning("Error linking NFC tag: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 400
 
 @app.route("/users/<user_id>/nfc", methods=["GET"])
 def list_user_nfc(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT tag_id, user_id, created_at, updated_at FROM nfc_tags WHERE user_id=?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([{"tag_id": r[0], "user_id": r[1], "created_at": r[2], "updated_at": r[3]} for r in rows])
+    """List a user's tags in link order, paged along idx_nfc_tags_user."""
+    try:
+        limit = parse_limit()
+        after = decode_cursor(request.args.get("after"), int)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT tag_id, user_id, created_at, updated_at, rowid FROM nfc_tags
+            WHERE user_id=? AND rowid > ?
+            ORDER BY rowid LIMIT ?
+        """, (user_id, after[0] if after else 0, limit))
+        rows = c.fetchall()
+
+    next_cursor = encode_cursor([rows[-1][4]]) if len(rows) == limit else None
+    return jsonify({
+        "items": [{"tag_id": r[0], "user_id": r[1], "created_at": r[2], "updated_at": r[3]} for r in rows],
+        "next": next_cursor
+    })
 
 @app.route("/nfc/<user_id>", methods=["GET"])
 def list_nfc(user_id):
@@ -480,108 +1064,129 @@ def list_nfc(user_id):
 
 @app.route("/nfc/<tag_id>", methods=["DELETE"])
 def unlink_nfc(tag_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM nfc_tags WHERE tag_id=?", (tag_id,))
-    if c.rowcount == 0:
-        conn.close()
+    deleted = writer.run(lambda conn: conn.execute("DELETE FROM nfc_tags WHERE tag_id=?", (tag_id,)).rowcount)
+    if deleted == 0:
         return jsonify({"status": "error", "message": "Tag not found"}), 404
-    conn.commit()
-    conn.close()
+    tag_cache.invalidate_tag(tag_id)
+    missing_roster.invalidate()
     log_action("DELETE", "nfc_tags", f"Tag {tag_id} unlinked")
     return jsonify({"status": "ok"})
 
 @app.route("/nfc/<tag_id>", methods=["GET"])
 def get_nfc_tag(tag_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT tag_id, user_id, created_at, updated_at FROM nfc_tags WHERE tag_id=?", (tag_id,))
-    row = c.fetchone()
-    conn.close()
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT tag_id, user_id, created_at, updated_at FROM nfc_tags WHERE tag_id=?", (tag_id,))
+        row = c.fetchone()
     if not row:
         return jsonify({"status": "error", "message": "Tag not found"}), 404
     return jsonify({"tag_id": row[0], "user_id": row[1], "created_at": row[2], "updated_at": row[3]})
 
+def resync_tag_cache():
+    """Drop cached tag records if another process changed tags or users."""
+    with pool.connection() as conn:
+        tag_cache.resync(read_table_versions(conn, TAG_CACHE_TABLES))
+
 @app.route("/nfc/<tag_id>/user", methods=["GET"])
 def get_user_by_nfc(tag_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    print(f"Looking up user for NFC tag: {tag_id}")
-    
-    c.execute("SELECT user_id FROM nfc_tags WHERE tag_id=?", (tag_id,))
-    row = c.fetchone()
+    if tag_cache.needs_resync():
+        resync_tag_cache()
+    user = tag_cache.get(tag_id)
+    if user is None:
+        with pool.connection() as conn:
+            user_id, user = lookup_tag_user(conn, tag_id)
+        if user_id is None:
+            request_log.info("NFC tag not found: %s", tag_id)
+            return jsonify({"status": "error", "message": "Tag not found"}), 404
+        if user is None:
+            request_log.info("User not found for NFC tag %s: %s", tag_id, user_id)
+            return jsonify({"status": "error", "message": "User not found"}), 404
+
+    return jsonify(user)
+
+def lookup_tag_user(conn, tag_id):
+    """Resolve a tag to ``(user_id, user record)`` with one join and cache the record.
+
+    Returns ``(None, None)`` for an unknown tag and ``(user_id, None)`` when
+    the tag points at a user that no longer exists.
+    """
+    generation = tag_cache.generation()
+    row = conn.execute("""
+        SELECT t.user_id, u.id, u.name, u.email, u.created_at, u.updated_at
+        FROM nfc_tags t
+        LEFT JOIN users u ON u.id = t.user_id
+        WHERE t.tag_id=?
+    """, (tag_id,)).fetchone()
     if not row:
-        conn.close()
-        print(f"NFC tag not found: {tag_id}")
-        return jsonify({"status": "error", "message": "Tag not found"}), 404
-        
-    user_id = row[0]
-    print(f"Found user_id: {user_id} for tag: {tag_id}")
-    
-    c.execute("SELECT id, name, email, created_at, updated_at FROM users WHERE id=?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    
-    if not user:
-        print(f"User not found with ID: {user_id}")
-        return jsonify({"status": "error", "message": "User not found"}), 404
-        
-    print(f"Returning user details for ID: {user_id}")
-    return jsonify({"id": user[0], "name": user[1], "email": user[2], "created_at": user[3], "updated_at": user[4]})
+        return None, None
+    if row[1] is None:
+        return row[0], None
+    user = {"id": row[1], "name": row[2], "email": row[3], "created_at": row[4], "updated_at": row[5]}
+    tag_cache.put(tag_id, user, generation)
+    return row[0], user
 
 @app.route("/attendance", methods=["POST"])
+@idempotent(lambda body: (body["tag_id"], body.get("date") or datetime.date.today().isoformat())
+            if body.get("tag_id") else None)
 def mark_attendance():
     """Mark attendance for a user via NFC tag. Default is absent."""
     data = request.json
     try:
-        print(f"Attendance request received: {data}")
+        log_request_body(data)
         
         if not data or "tag_id" not in data:
             error_msg = "Missing required field: tag_id"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
         
         tag_id = data["tag_id"]
         status = data.get("status", "absent")  
         date = data.get("date", datetime.date.today().isoformat())  
         
+        if not isinstance(tag_id, str):
+            error_msg = "Field tag_id must be a string"
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+            return jsonify({"status": "error", "message": error_msg}), 400
+        
         if status not in ["present", "absent"]:
             error_msg = "Status must be 'present' or 'absent'"
-            print(f"Error: {error_msg}")
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
             return jsonify({"status": "error", "message": error_msg}), 400
         
-        with db_lock:
-            conn = get_db_connection()
+        def upsert_attendance(conn):
             c = conn.cursor()
-            
-            c.execute("SELECT user_id FROM nfc_tags WHERE tag_id=?", (tag_id,))
-            tag_row = c.fetchone()
-            if not tag_row:
-                conn.close()
-                error_msg = f"NFC tag not found: {tag_id}"
-                print(f"Error: {error_msg}")
-                return jsonify({"status": "error", "message": error_msg}), 400
-            
-            user_id = tag_row[0]
-            
+
+            # Resolved inside the write transaction, not from tag_cache: another
+            # worker may have unlinked or re-linked the tag since it was cached.
+            row = c.execute("SELECT user_id FROM nfc_tags WHERE tag_id=?", (tag_id,)).fetchone()
+            if row is None:
+                return None, None, None
+            user_id = row[0]
+            before = attendance_version(conn)
+
             c.execute("SELECT id, status FROM attendance WHERE tag_id=? AND date=?", (tag_id, date))
-            existing = c.fetchone()
-            
-            if existing:
-                c.execute("UPDATE attendance SET status=?, user_id=? WHERE tag_id=? AND date=?", 
+            if c.fetchone():
+                c.execute("UPDATE attendance SET status=?, user_id=? WHERE tag_id=? AND date=?",
                          (status, user_id, tag_id, date))
-                log_action("UPDATE", "attendance", f"Tag {tag_id} marked as {status} for {date}")
-                print(f"Updated attendance: Tag {tag_id} marked as {status} for {date}")
+                action = "UPDATE"
             else:
                 c.execute("INSERT INTO attendance (tag_id, user_id, status, date) VALUES (?, ?, ?, ?)",
                          (tag_id, user_id, status, date))
-                log_action("INSERT", "attendance", f"Tag {tag_id} marked as {status} for {date}")
-                print(f"Created attendance: Tag {tag_id} marked as {status} for {date}")
-            
-            conn.commit()
-            conn.close()
-        
+                action = "INSERT"
+            return user_id, action, (before, attendance_version(conn))
+
+        user_id, action, versions = writer.run(upsert_attendance)
+        if action is None:
+            error_msg = f"NFC tag not found: {tag_id}"
+            request_log.info("Rejected %s %s: %s", request.method, request.path, error_msg)
+            return jsonify({"status": "error", "message": error_msg}), 400
+
+        missing_roster.record_own_writes(*versions)
+        missing_roster.mark_attended(tag_id, date)
+        log_action(action, "attendance", f"Tag {tag_id} marked as {status} for {date}")
+        attendance_tail.wake()
+        request_log.info("Attendance %s: tag %s marked as %s for %s", action.lower(), tag_id, status, date)
+
         return jsonify({
             "status": "ok", 
             "message": f"Attendance marked as {status} for tag {tag_id}",
@@ -592,104 +1197,583 @@ def mark_attendance():
         }), 201
         
     except Exception as e:
-        print(f"Error marking attendance: {str(e)}")
+        log.exception("Error marking attendance")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+ATTENDANCE_BATCH_MAX_ITEMS = int(os.environ.get("ATTENDANCE_BATCH_MAX_ITEMS", "5000"))
+
+UPSERT_ATTENDANCE_SQL = """
+    INSERT INTO attendance (tag_id, user_id, status, date) VALUES (?, ?, ?, ?)
+    ON CONFLICT(tag_id, date) DO UPDATE SET status=excluded.status, user_id=excluded.user_id
+"""
+
+def resolve_tags(conn, tag_ids, chunk_size=500):
+    """Map each known tag id to its user id, read in the caller's write transaction."""
+    users = {}
+    tag_ids = list(tag_ids)
+    for i in range(0, len(tag_ids), chunk_size):
+        chunk = tag_ids[i:i + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        for tag_id, user_id in conn.execute(
+                f"SELECT tag_id, user_id FROM nfc_tags WHERE tag_id IN ({placeholders})", chunk):
+            users[tag_id] = user_id
+    return users
+
+def read_batch_items():
+    """Read a JSON array, an {"items": [...]} object or an NDJSON body."""
+    if "ndjson" in (request.mimetype or ""):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip():
+                items.append(json.loads(line))
+        return items
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        data = data.get("items")
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of attendance items")
+    return data
+
+@app.route("/attendance/batch", methods=["POST"])
+def mark_attendance_batch():
+    """Upsert many taps at once, e.g. from a reader that was offline."""
+    try:
+        items = read_batch_items()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid batch body: {e}"}), 400
+
+    if len(items) > ATTENDANCE_BATCH_MAX_ITEMS:
+        error_msg = f"Batch too large: {len(items)} items (max {ATTENDANCE_BATCH_MAX_ITEMS})"
+        return jsonify({"status": "error", "message": error_msg}), 413
+
+    today = datetime.date.today().isoformat()
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("tag_id"):
+            results.append({"index": index, "status": "error", "message": "Missing required field: tag_id"})
+            continue
+        if not isinstance(item["tag_id"], str):
+            results.append({"index": index, "status": "error", "message": "Field tag_id must be a string"})
+            continue
+        status = item.get("status", "absent")
+        if status not in ["present", "absent"]:
+            results.append({"index": index, "status": "error", "tag_id": item["tag_id"],
+                            "message": "Status must be 'present' or 'absent'"})
+            continue
+        date = item.get("date") or today
+        try:
+            date = datetime.date.fromisoformat(date).isoformat()
+        except (TypeError, ValueError):
+            results.append({"index": index, "status": "error", "tag_id": item["tag_id"],
+                            "message": "Date must be YYYY-MM-DD"})
+            continue
+        result = {"index": index, "status": "ok", "tag_id": item["tag_id"],
+                  "attendance_status": status, "date": date}
+        results.append(result)
+        valid.append(result)
+
+    def upsert_batch(conn):
+        users = resolve_tags(conn, {r["tag_id"] for r in valid})
+        rows = [(r["tag_id"], users[r["tag_id"]], r["attendance_status"], r["date"])
+                for r in valid if r["tag_id"] in users]
+        before = attendance_version(conn)
+        conn.executemany(UPSERT_ATTENDANCE_SQL, rows)
+        return users, (before, attendance_version(conn))
+
+    try:
+        users, versions = writer.run(upsert_batch) if valid else ({}, None)
+    except Exception as e:
+        log.exception("Error marking attendance batch")
+        return jsonify({"status": "error", "message": str(e)}), 500
+    if versions:
+        missing_roster.record_own_writes(*versions)
+
+    applied = 0
+    for result in valid:
+        if result["tag_id"] in users:
+            result["user_id"] = users[result["tag_id"]]
+            applied += 1
+            missing_roster.mark_attended(result["tag_id"], result["date"])
+            # A single tap debounced before this batch no longer describes the row.
+            tap_debounce.discard(("POST", "/attendance", result["tag_id"], result["date"]))
+            log_action("UPSERT", "attendance",
+                       f"Tag {result['tag_id']} marked as {result['attendance_status']} for {result['date']}")
+        else:
+            result["status"] = "error"
+            result["message"] = f"NFC tag not found: {result['tag_id']}"
+
+    if applied:
+        attendance_tail.wake()
+    request_log.info("Attendance batch: %d of %d items applied", applied, len(items))
+    return jsonify({
+        "status": "ok",
+        "applied": applied,
+        "failed": len(items) - applied,
+        "results": results
+    })
+
+CLOSE_DAY_MAX_DAYS = int(os.environ.get("CLOSE_DAY_MAX_DAYS", "366"))
+CLOSE_DAY_LOOKBACK = int(os.environ.get("CLOSE_DAY_LOOKBACK", "1"))
+
+# Tags linked after the day being closed are skipped. The NOT EXISTS probe
+# already makes this idempotent; DO NOTHING keeps it so if the two ever race.
+CLOSE_DAY_SQL = """
+    INSERT INTO attendance (tag_id, user_id, status, date)
+    SELECT t.tag_id, t.user_id, 'absent', :date
+    FROM nfc_tags t
+    WHERE t.created_at < date(:date, '+1 day')
+      AND NOT EXISTS (SELECT 1 FROM attendance a WHERE a.tag_id = t.tag_id AND a.date = :date)
+    ON CONFLICT(tag_id, date) DO NOTHING
+"""
+
+def close_day(date):
+    """Materialise absences for ``date`` in one INSERT ... SELECT; returns rows inserted."""
+    inserted = writer.run(lambda conn: conn.execute(CLOSE_DAY_SQL, {"date": date}).rowcount)
+    if inserted:
+        log_action("CLOSE_DAY", "attendance", f"{inserted} absences recorded for {date}")
+    return inserted
+
+def close_days(date_from, date_to):
+    """Close every date from ``date_from`` to ``date_to``, one write transaction per date.
+
+    Only past days can be closed: closing today would mark everyone who has
+    not tapped yet as absent.
+    """
+    start = datetime.date.fromisoformat(date_from)
+    end = datetime.date.fromisoformat(date_to)
+    if end < start:
+        raise ValueError("'to' must not be before 'from'")
+    if end >= datetime.date.today():
+        raise ValueError("Only days before today can be closed")
+    if (end - start).days >= CLOSE_DAY_MAX_DAYS:
+        raise ValueError(f"At most {CLOSE_DAY_MAX_DAYS} days can be closed at once")
+    closed = {}
+    for offset in range((end - start).days + 1):
+        date = (start + datetime.timedelta(days=offset)).isoformat()
+        closed[date] = close_day(date)
+    return closed
+
+def close_recent_days():
+    """Scheduled close: the last CLOSE_DAY_LOOKBACK days before today."""
+    today = datetime.date.today()
+    closed = close_days((today - datetime.timedelta(days=CLOSE_DAY_LOOKBACK)).isoformat(),
+                        (today - datetime.timedelta(days=1)).isoformat())
+    return sum(closed.values())
+
+@app.route("/admin/close-day", methods=["POST"])
+def close_day_admin():
+    """Backfill absences for a date range: ``from`` (default yesterday) to ``to`` (default ``from``)."""
+    data = request.get_json(silent=True) or {}
+    date_from = data.get("from") or request.args.get("from") or \
+        (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    date_to = data.get("to") or request.args.get("to") or date_from
+    try:
+        closed = close_days(date_from, date_to)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "ok", "inserted": sum(closed.values()), "closed": closed})
+
+# Each query shape is served in index order:
+#   tag_id  -> sqlite_autoindex_attendance_1 (tag_id, date), one row per date
+#   user_id -> idx_attendance_user_date_created (user_id, date, created_at)
+#   range   -> idx_attendance_date_created (date, created_at)
+ATTENDANCE_QUERY = """
+    SELECT a.id, a.tag_id, a.user_id, u.name, u.email, a.status, a.date, a.created_at, a.updated_at
+    FROM attendance a
+    LEFT JOIN users u ON a.user_id = u.id
+    WHERE {where}
+    ORDER BY a.date DESC, a.created_at DESC, a.id DESC
+"""
+
+MAX_FILTER_VALUES = 100
+
+def split_values(name):
+    """Comma-separated query parameter as a list of distinct values."""
+    values = list(dict.fromkeys(v.strip() for v in request.args.get(name, "").split(",") if v.strip()))
+    if len(values) > MAX_FILTER_VALUES:
+        raise ValueError(f"At most {MAX_FILTER_VALUES} values allowed for {name}")
+    return values
+
+ATTENDANCE_LIMIT_DEFAULT = int(os.environ.get("ATTENDANCE_LIMIT_DEFAULT", "1000"))
+ATTENDANCE_LIMIT_MAX = int(os.environ.get("ATTENDANCE_LIMIT_MAX", "5000"))
+
 @app.route("/attendance", methods=["GET"])
+@conditional("attendance", "users")
 def get_attendance():
-    """Get attendance records with optional filtering."""
+    """Attendance rows, newest date first, filtered by date range, users, tags and status.
+
+    ``date`` selects one day and ``from``/``to`` an inclusive range; with
+    neither, today is returned. ``user_id`` and ``tag_id`` take
+    comma-separated lists. With a list, each value is read in index order
+    by its own query and the streams are merged, so no query needs a
+    temporary sort.
+
+    At most ``limit`` rows are returned (ATTENDANCE_LIMIT_DEFAULT, capped at
+    ATTENDANCE_LIMIT_MAX). A truncated result carries a ``Link`` header to
+    /attendance/export for the same range, which streams any number of rows.
+    """
     try:
-        date = request.args.get("date", datetime.date.today().isoformat())
-        user_id = request.args.get("user_id")
-        tag_id = request.args.get("tag_id")
-        
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        query = """
-            SELECT a.id, a.tag_id, a.user_id, u.name, u.email, a.status, a.date, a.created_at, a.updated_at 
-            FROM attendance a 
-            LEFT JOIN users u ON a.user_id = u.id 
-            WHERE 1=1
-        """
-        params = []
-        
-        if date:
-            query += " AND a.date = ?"
-            params.append(date)
-        
-        if user_id:
-            query += " AND a.user_id = ?"
-            params.append(user_id)
-            
-        if tag_id:
-            query += " AND a.tag_id = ?"
-            params.append(tag_id)
-        
-        query += " ORDER BY a.created_at DESC"
-        
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
-        
-        return jsonify([{
-            "id": r[0],
-            "tag_id": r[1], 
-            "user_id": r[2],
-            "user_name": r[3],
-            "user_email": r[4],
-            "status": r[5],
-            "date": r[6],
-            "created_at": r[7],
-            "updated_at": r[8]
-        } for r in rows])
-        
+        date = request.args.get("date")
+        date_from = request.args.get("from") or date
+        date_to = request.args.get("to") or date
+        if not (date_from or date_to):
+            date_from = date_to = datetime.date.today().isoformat()
+        for value in (date_from, date_to):
+            if value:
+                datetime.date.fromisoformat(value)
+        user_ids = split_values("user_id")
+        tag_ids = split_values("tag_id")
+        status = request.args.get("status")
+        if status and status not in ("present", "absent"):
+            raise ValueError("status must be 'present' or 'absent'")
+        limit = parse_limit(ATTENDANCE_LIMIT_DEFAULT, ATTENDANCE_LIMIT_MAX)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    # Drive the query from the most selective filter: tags (unique per date),
+    # then users, then the date range alone.
+    if tag_ids:
+        driver, values = "a.tag_id = ?", tag_ids
+    elif user_ids:
+        driver, values = "a.user_id = ?", user_ids
+    else:
+        driver, values = None, [None]
+
+    conditions, params = [], []
+    if date_from:
+        conditions.append("a.date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("a.date <= ?")
+        params.append(date_to)
+    if tag_ids and user_ids:
+        conditions.append(f"a.user_id IN ({','.join('?' * len(user_ids))})")
+        params += user_ids
+    if status:
+        conditions.append("a.status = ?")
+        params.append(status)
+
+    query = ATTENDANCE_QUERY.format(where=" AND ".join(([driver] if driver else []) + conditions) or "1=1")
+    # One row past the limit tells whether the result was truncated.
+    query += f" LIMIT {limit + 1}"
+
+    try:
+        with pool.connection() as conn:
+            streams = [conn.execute(query, ([value] if driver else []) + params) for value in values]
+            rows = streams[0] if len(streams) == 1 else heapq.merge(
+                *streams, key=lambda r: (r[6], r[7] or "", r[0]), reverse=True)
+            rows = list(itertools.islice(rows, limit + 1))
     except Exception as e:
-        print(f"Error getting attendance: {e}")
+        log.warning("Error getting attendance: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+    truncated = len(rows) > limit
+    response = jsonify([{
+        "id": r[0],
+        "tag_id": r[1],
+        "user_id": r[2],
+        "user_name": r[3],
+        "user_email": r[4],
+        "status": r[5],
+        "date": r[6],
+        "created_at": r[7],
+        "updated_at": r[8]
+    } for r in rows[:limit]])
+    if truncated:
+        export = urllib.parse.urlencode({k: v for k, v in (("from", date_from), ("to", date_to)) if v})
+        response.headers["Link"] = f'</attendance/export?{export}>; rel="alternate"; type="application/x-ndjson"'
+    return response
+
+ATTENDANCE_EXPORT_CHUNK = int(os.environ.get("ATTENDANCE_EXPORT_CHUNK", "1000"))
+
+EXPORT_COLUMNS = ["id", "tag_id", "user_id", "user_name", "user_email", "status", "date", "created_at", "updated_at"]
+
+def export_attendance_rows(date_from, date_to, fmt, compress):
+    """Yield encoded export chunks, ``ATTENDANCE_EXPORT_CHUNK`` rows at a time."""
+    gzipper = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+
+    def encode(rows):
+        if fmt == "csv":
+            out = io.StringIO()
+            csv.writer(out).writerows(rows)
+            data = out.getvalue().encode()
+        else:
+            data = "".join(json.dumps(dict(zip(EXPORT_COLUMNS, r))) + "\n" for r in rows).encode()
+        return gzipper.compress(data) if gzipper else data
+
+    if fmt == "csv":
+        yield encode([EXPORT_COLUMNS])
+    with pool.connection() as conn:
+        cursor = conn.execute("""
+            SELECT a.id, a.tag_id, a.user_id, u.name, u.email, a.status, a.date, a.created_at, a.updated_at
+            FROM attendance a
+            LEFT JOIN users u ON a.user_id = u.id
+            WHERE a.date >= ? AND a.date <= ?
+            ORDER BY a.date, a.created_at, a.id
+        """, (date_from, date_to))
+        try:
+            while True:
+                rows = cursor.fetchmany(ATTENDANCE_EXPORT_CHUNK)
+                if not rows:
+                    break
+                chunk = encode(rows)
+                if chunk:
+                    yield chunk
+        finally:
+            cursor.close()
+    if gzipper:
+        yield gzipper.flush()
+
+@app.route("/attendance/export", methods=["GET"])
+def export_attendance():
+    """Stream attendance for ``from``..``to`` (inclusive) as NDJSON or CSV.
+
+    Rows are read in ``fetchmany`` chunks and written out as they are read,
+    so memory use does not depend on the size of the range. The body is
+    gzip-encoded when the client sends ``Accept-Encoding: gzip``.
+    """
+    date_from = request.args.get("from")
+    date_to = request.args.get("to") or date_from
+    fmt = request.args.get("format", "ndjson")
+    try:
+        if not date_from:
+            raise ValueError("Missing required parameter: from")
+        datetime.date.fromisoformat(date_from)
+        datetime.date.fromisoformat(date_to)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"status": "error", "message": "format must be 'ndjson' or 'csv'"}), 400
+
+    compress = request.accept_encodings["gzip"] > 0
+    headers = {
+        "Content-Disposition": f'attachment; filename="attendance-{date_from}-{date_to}.{fmt}"',
+        "Vary": "Accept-Encoding",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(export_attendance_rows(date_from, date_to, fmt, compress), mimetype=mimetype, headers=headers)
+
+@app.route("/attendance/summary", methods=["GET"])
+@conditional("attendance")
+def attendance_summary():
+    """Present/absent counts from the rollups: per date, or per user and month."""
+    user_id = request.args.get("user_id")
+    with pool.connection() as conn:
+        c = conn.cursor()
+        if user_id:
+            month = request.args.get("month", datetime.date.today().isoformat()[:7])
+            c.execute("SELECT present, absent FROM attendance_user_monthly WHERE user_id=? AND month=?",
+                      (user_id, month))
+            present, absent = c.fetchone() or (0, 0)
+            total = present + absent
+            return jsonify({
+                "user_id": user_id,
+                "month": month,
+                "present": present,
+                "absent": absent,
+                "total": total,
+                "attendance_rate": present / total if total else None
+            })
+
+        date = request.args.get("date", datetime.date.today().isoformat())
+        c.execute("SELECT present, absent FROM attendance_daily WHERE date=?", (date,))
+        present, absent = c.fetchone() or (0, 0)
+    return jsonify({"date": date, "present": present, "absent": absent, "total": present + absent})
+
+@app.route("/attendance/stream", methods=["GET"])
+def attendance_stream():
+    """Server-Sent Events feed of attendance changes as they are committed.
+
+    Event ids are ``changes`` seqs and the data is the change payload.
+    Optional ``date`` and ``user_id`` filters; reconnecting clients resume
+    from the Last-Event-ID header (or ``last_event_id`` query parameter) on
+    any worker.
+    """
+    date = request.args.get("date")
+    user_id = request.args.get("user_id")
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid Last-Event-ID"}), 400
+
+    if attendance_events.full():
+        return jsonify({"status": "error", "message": "Too many open streams"}), 503, {"Retry-After": "10"}
+    attendance_tail.start()
+
+    def match(event):
+        return (not date or event["date"] == date) and (not user_id or event["user_id"] == user_id)
+
+    return Response(attendance_events.subscribe(last_event_id, match), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/attendance/missing", methods=["GET"])
+def attendance_missing():
+    """Registered tags with no attendance row for ``date`` (default today).
+
+    Today is served from the in-memory roster; other dates run the anti-join.
+    """
+    date = request.args.get("date")
+    try:
+        if date:
+            datetime.date.fromisoformat(date)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        if not date or date == datetime.date.today().isoformat():
+            date, items = missing_roster.missing(conn)
+        else:
+            items = query_missing(conn, date)
+    return jsonify({"date": date, "count": len(items), "items": items})
+
 @app.route("/attendance/<int:attendance_id>", methods=["DELETE"])
 def delete_attendance(attendance_id):
     """Delete an attendance record."""
     try:
-        with db_lock:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("DELETE FROM attendance WHERE id=?", (attendance_id,))
-            if c.rowcount == 0:
-                conn.close()
-                return jsonify({"status": "error", "message": "Attendance record not found"}), 404
-            conn.commit()
-            conn.close()
-        
+        deleted = writer.run(
+            lambda conn: conn.execute("DELETE FROM attendance WHERE id=?", (attendance_id,)).rowcount)
+        if deleted == 0:
+            return jsonify({"status": "error", "message": "Attendance record not found"}), 404
+
+        missing_roster.invalidate()
         log_action("DELETE", "attendance", f"Attendance record {attendance_id} deleted")
         return jsonify({"status": "ok"})
     except Exception as e:
-        print(f"Error deleting attendance: {e}")
+        log.warning("Error deleting attendance: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route("/audit", methods=["GET"])
+@conditional("audit_logs")
 def audit():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, action, table_name, details, timestamp FROM audit_logs ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([{"id": r[0], "action": r[1], "table": r[2], "details": r[3], "timestamp": r[4]} for r in rows])
+    """Page through audit logs newest first.
+
+    Pages are keyed on ``before_id`` so every page is an index range scan.
+    A ``since``/``until`` range is first narrowed to an id range through the
+    timestamp index, widened by AUDIT_TIMESTAMP_SKEW because buffered rows
+    from several workers do not get ids in exact timestamp order; the
+    timestamps themselves are then filtered exactly.
+    """
+    try:
+        limit = parse_limit()
+        before_id = parse_id_param("before_id")
+        action = request.args.get("action")
+        table_name = request.args.get("table_name") or request.args.get("table")
+        since = parse_timestamp_param("since")
+        until = parse_timestamp_param("until")
+        with pool.connection() as conn:
+            low = lower_id_bound(conn, since, AUDIT_TIMESTAMP_SKEW) if since else None
+            high = upper_id_bound(conn, until, AUDIT_TIMESTAMP_SKEW) if until else None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        query = "SELECT id, action, table_name, details, timestamp FROM audit_logs WHERE 1=1"
+        params = []
+
+        if since:
+            query += " AND timestamp >= ?"
+            params.append(since)
+            if low is not None:
+                query += " AND id >= ?"
+                params.append(low)
+
+        if until:
+            query += " AND timestamp < ?"
+            params.append(until)
+            if high is not None:
+                query += " AND id <= ?"
+                params.append(high)
+
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+
+        if action:
+            query += " AND action = ?"
+            params.append(action)
+
+        if table_name:
+            query += " AND table_name = ?"
+            params.append(table_name)
+
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
+        c.execute(query, params)
+        rows = c.fetchall()
+
+    next_before_id = rows[-1][0] if len(rows) == limit else None
+    return jsonify({
+        "items": [{"id": r[0], "action": r[1], "table": r[2], "details": r[3], "timestamp": r[4]} for r in rows],
+        "next": next_before_id
+    })
+
+@app.route("/audit/archive", methods=["GET"])
+def audit_archive():
+    """Page through archived audit rows newest first, with the same filters as /audit."""
+    try:
+        limit = parse_limit()
+        before_id = parse_id_param("before_id")
+        since = parse_timestamp_param("since")
+        until = parse_timestamp_param("until")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    items, next_before_id = audit_retention.query_archive(
+        since=since,
+        until=until,
+        before_id=before_id,
+        action=request.args.get("action"),
+        table_name=request.args.get("table_name") or request.args.get("table"),
+        limit=limit,
+    )
+    return jsonify({"items": items, "next": next_before_id})
+
+@app.route("/changes", methods=["GET"])
+def list_changes():
+    """Changes after ``since`` in commit order, for clients syncing incrementally.
+
+    Clients keep the ``next`` seq and pass it back as ``since``. A client
+    that fell behind the retention window gets 410 and should reload the
+    lists it mirrors, then follow on from ``latest``, which it reads
+    before reloading so nothing committed in between is missed.
+    """
+    try:
+        limit = parse_limit(100, 1000)
+        since = int(request.args.get("since", 0))
+        entity = request.args.get("entity")
+        if entity and entity not in CHANGE_ENTITIES:
+            raise ValueError(f"entity must be one of {', '.join(CHANGE_ENTITIES)}")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    with pool.connection() as conn:
+        oldest, latest = feed_bounds(conn)
+        if oldest is not None and since < oldest - 1:
+            return jsonify({"status": "error", "message": "Changes since this seq are no longer retained",
+                            "oldest": oldest, "latest": latest}), 410
+        items = read_changes(conn, since, limit, entity)
+
+    return jsonify({
+        "items": items,
+        "next": items[-1]["seq"] if items else max(since, latest or 0),
+        "more": len(items) == limit,
+    })
 
 @app.route("/users/<user_id>", methods=["DELETE"])
 def delete_user(user_id):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        
-        c.execute("DELETE FROM users WHERE id=?", (user_id,))
-        if c.rowcount == 0:
-            conn.close()
+        deleted = writer.run(lambda conn: conn.execute("DELETE FROM users WHERE id=?", (user_id,)).rowcount)
+        if deleted == 0:
             return jsonify({"status": "error", "message": "User not found"}), 404
-            
-        conn.commit()
-        conn.close()
+
+        tag_cache.invalidate_user(user_id)
+        missing_roster.invalidate()
         log_action("DELETE", "users", f"User {user_id} deleted")
         return jsonify({"status": "ok"})
     except Exception as e:
@@ -703,7 +1787,28 @@ def health_check():
         "api_version": "1.0.0"
     })
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "pool": pool.stats(),
+        "writer": writer.stats(),
+        "audit": audit_buffer.stats(),
+        "nfc_cache": tag_cache.stats(),
+        "attendance_events": attendance_events.stats(),
+        "attendance_tail": attendance_tail.stats(),
+        "audit_retention": audit_retention.stats(),
+        "missing_roster": missing_roster.stats(),
+        "change_retention": change_retention.stats(),
+        "idempotency": {"keys": idempotency_keys.stats(), "debounce": tap_debounce.stats()},
+        "jobs": {job.name: job.stats() for job in background_jobs}
+    })
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
-    print("Starting Daydream Sydney API server...")
-    print(f"Database: {os.path.abspath(DB_FILE)}")
-    app.run(host='0.0.0.0', port=1234, debug=True)
+    log.info("Starting development server, database %s", os.path.abspath(DB_FILE))
+    start_background_jobs()
+    app.run(host='0.0.0.0', port=int(os.environ.get("PORT", "1234")),
+            debug=os.environ.get("FLASK_DEBUG", "0") == "1", threaded=True)
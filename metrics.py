@@ -0,0 +1,224 @@
+import bisect
+import json
+import os
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.registry._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _reset(self):
+        self._values = {}
+
+    def collect(self):
+        with self.registry._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _reset(self):
+        self._series = {}
+
+    def collect(self):
+        with self.registry._lock:
+            return {labels: [list(counts), total, count] for labels, (counts, total, count) in self._series.items()}
+
+
+def _add(kind, a, b):
+    if kind != "histogram":
+        return a + b
+    return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """Process-local metrics rendered in the Prometheus text format.
+
+    Counters and histograms are updated in memory under one short lock.
+    Gauges are collected at scrape time from callbacks, so components that
+    already keep ``stats()`` dicts cost nothing on the hot path.
+
+    Under several worker processes a scrape reaches one of them at random,
+    so with ``enable_multiprocess(directory)`` every process writes its
+    values to ``<directory>/<pid>.json`` (on each scrape and from
+    ``write_snapshot``, which the app runs periodically) and a scrape sums
+    all the files. Counters of workers that exited are kept so totals stay
+    monotonic; their gauges are dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._gauges = []
+        self.directory = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        for metric in self._metrics:
+            metric._reset()
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(self, name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, collect, labelnames=(), kind="gauge"):
+        """Register ``collect()`` returning a number, or {label tuple: number}.
+
+        Pass ``kind="counter"`` for monotonic values read from a stats dict.
+        """
+        self._gauges.append((name, help, tuple(labelnames), collect, kind))
+
+    def enable_multiprocess(self, directory):
+        """Aggregate across processes through ``directory``; files of dead processes from earlier runs are removed."""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            pid = name.partition(".")[0]
+            if name.endswith(".json") and pid.isdigit() and not _alive(int(pid)):
+                os.remove(os.path.join(directory, name))
+        self.directory = directory
+
+    def _collect(self):
+        families = []
+        for metric in self._metrics:
+            families.append({"name": metric.name, "help": metric.help, "kind": metric.kind,
+                             "labelnames": metric.labelnames, "buckets": getattr(metric, "buckets", None),
+                             "series": metric.collect()})
+        for name, help, labelnames, collect, kind in self._gauges:
+            values = collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+            families.append({"name": name, "help": help, "kind": kind, "labelnames": labelnames,
+                             "buckets": None, "series": values})
+        return families
+
+    def write_snapshot(self, families=None):
+        """Write this process's values for other processes' scrapes to include."""
+        if self.directory is None:
+            return
+        families = self._collect() if families is None else families
+        snapshot = [dict(family, series=[[list(labels), value] for labels, value in family["series"].items()])
+                    for family in families]
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    def _merge_directory(self, local):
+        merged = {family["name"]: dict(family, series=dict(family["series"])) for family in local}
+        order = [family["name"] for family in local]
+        for name in sorted(os.listdir(self.directory)):
+            pid = name.partition(".")[0]
+            if not name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            alive = _alive(int(pid))
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for family in snapshot:
+                if family["kind"] == "gauge" and not alive:
+                    continue
+                target = merged.get(family["name"])
+                if target is None:
+                    target = merged[family["name"]] = dict(family, series={})
+                    order.append(family["name"])
+                for labels, value in family["series"]:
+                    labels = tuple(labels)
+                    current = target["series"].get(labels)
+                    target["series"][labels] = value if current is None else _add(family["kind"], current, value)
+        return [merged[name] for name in order]
+
+    def render(self):
+        families = self._collect()
+        if self.directory is not None:
+            self.write_snapshot(families)
+            families = self._merge_directory(families)
+        lines = []
+        for family in families:
+            name, labelnames = family["name"], family["labelnames"]
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for labels, value in sorted(family["series"].items()):
+                if family["kind"] != "histogram":
+                    lines.append(f"{name}{_labels(labelnames, labels)} {_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(tuple(family["buckets"]) + (float("inf"),), counts):
+                    cumulative += n
+                    le = 'le="' + _number(bound) + '"'
+                    lines.append(f"{name}_bucket{_labels(labelnames, labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labelnames, labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labelnames, labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,160 @@
+import datetime
+import os
+import threading
+import time
+
+MISSING_SQL = """
+    SELECT t.tag_id, t.user_id, u.name, u.email
+    FROM nfc_tags t
+    LEFT JOIN users u ON u.id = t.user_id
+    WHERE NOT EXISTS (SELECT 1 FROM attendance a WHERE a.tag_id = t.tag_id AND a.date = ?)
+    ORDER BY t.tag_id
+"""
+
+ROSTER_TABLES = ("attendance", "nfc_tags", "users")
+MAX_OWN_VERSIONS = 10000
+
+
+def query_missing(conn, date):
+    """Registered tags with no attendance row on ``date``: one anti-join over the (tag_id, date) index."""
+    return [{"tag_id": r[0], "user_id": r[1], "user_name": r[2], "user_email": r[3]}
+            for r in conn.execute(MISSING_SQL, (date,))]
+
+
+def read_versions(conn):
+    placeholders = ",".join("?" * len(ROSTER_TABLES))
+    return dict(conn.execute(f"SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})",
+                             ROSTER_TABLES).fetchall())
+
+
+def attendance_version(conn):
+    """The attendance table version; read before and after a write inside its transaction."""
+    return conn.execute("SELECT version FROM table_versions WHERE table_name = 'attendance'").fetchone()[0]
+
+
+class MissingRoster:
+    """Today's not-yet-tapped tags, kept in memory and updated as taps commit.
+
+    The set is loaded with the anti-join in ``query_missing`` and then kept
+    current by ``mark_attended`` from this process's write paths. Changes
+    that cannot be applied in place (tags linked or unlinked, users edited,
+    rows deleted) call ``invalidate`` and the next read reloads. Writes from
+    other worker processes are picked up by comparing table_versions: when
+    they moved, the set is reloaded at most once per ``resync_interval``.
+    This process's own taps also move the attendance version, so their
+    write paths pass the versions they moved it through to
+    ``record_own_writes``; only a version nobody here recorded forces a
+    reload.
+    """
+
+    def __init__(self, resync_interval=5.0):
+        self.resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._date = None
+        self._missing = {}
+        self._listing = None
+        self._versions = None
+        self._loaded_at = 0.0
+        self._stale = True
+        self._tapped_while_loading = None
+        self._own_versions = set()
+        self._stats = {"loads": 0, "served": 0, "taps_applied": 0}
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._tapped_while_loading = None
+        self._own_versions = set()
+        self._stale = True
+
+    def mark_attended(self, tag_id, date):
+        with self._lock:
+            if self._tapped_while_loading is not None:
+                self._tapped_while_loading.add(tag_id)
+            if date != self._date:
+                return
+            if self._missing.pop(tag_id, None) is not None:
+                self._listing = None
+            self._stats["taps_applied"] += 1
+
+    def record_own_writes(self, before, after):
+        """Note that this process moved the attendance version from ``before`` to ``after``.
+
+        Commits can be recorded out of order, so versions are collected and
+        the loaded version only advances over an unbroken run of them.
+        """
+        with self._lock:
+            if self._versions is None and self._tapped_while_loading is None:
+                return
+            self._own_versions.update(range(before + 1, after + 1))
+            self._advance()
+            # A gap from another process is only closed by a reload; until the
+            # next read does one, stop collecting.
+            if len(self._own_versions) > MAX_OWN_VERSIONS:
+                self._own_versions = set()
+                self._stale = True
+
+    def _advance(self):
+        """Move the loaded attendance version over recorded own writes; the caller holds the lock."""
+        if self._versions is None:
+            return
+        version = self._versions.get("attendance", 0)
+        while version + 1 in self._own_versions:
+            version += 1
+        self._versions["attendance"] = version
+        self._own_versions = {v for v in self._own_versions if v > version}
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+
+    def _needs_reload(self, conn, today):
+        if self._stale or self._date != today:
+            return True
+        if time.monotonic() - self._loaded_at < self.resync_interval:
+            return False
+        with self._lock:
+            versions = dict(self._versions)
+        return read_versions(conn) != versions
+
+    def _load(self, conn, today):
+        with self._lock:
+            self._tapped_while_loading = set()
+            self._stale = False
+        # Versions first: anything committed after this point is either in the
+        # query result or shows up as a version change on the next check.
+        versions = read_versions(conn)
+        rows = query_missing(conn, today)
+        with self._lock:
+            tapped = self._tapped_while_loading
+            self._tapped_while_loading = None
+            self._missing = {r["tag_id"]: r for r in rows if r["tag_id"] not in tapped}
+            self._listing = None
+            self._date = today
+            self._versions = versions
+            self._advance()
+            self._loaded_at = time.monotonic()
+            self._stats["loads"] += 1
+
+    def missing(self, conn):
+        """Missing records for today, sorted by tag id."""
+        today = datetime.date.today().isoformat()
+        if self._needs_reload(conn, today):
+            with self._load_lock:
+                if self._needs_reload(conn, today):
+                    self._load(conn, today)
+        with self._lock:
+            if self._listing is None:
+                self._listing = [self._missing[tag_id] for tag_id in sorted(self._missing)]
+            self._stats["served"] += 1
+            return today, self._listing
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["date"] = self._date
+            stats["missing"] = len(self._missing)
+        stats["resync_interval"] = self.resync_interval
+        return stats
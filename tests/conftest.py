@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# main opens its database at import time; point it at a scratch file first.
+_scratch = tempfile.mkdtemp(prefix="daydream-tests-")
+os.environ.setdefault("DB_FILE", os.path.join(_scratch, "test.db"))
+os.environ.setdefault("BACKGROUND_JOBS", "0")
+os.environ.setdefault("SAMPLE_DATA", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,121 @@
+import uuid
+
+import pytest
+
+from idempotency import IdempotencyCache
+
+
+def test_cache_replays_same_fingerprint_and_reports_mismatch():
+    cache = IdempotencyCache(ttl=60)
+    entry, owner = cache.begin("k", "body-1")
+    assert owner
+    cache.complete("k", entry, ("ok", 201, "application/json"))
+
+    again, owner = cache.begin("k", "body-1")
+    assert not owner
+    assert cache.wait(again, 1) == ("ok", 201, "application/json")
+
+    other, owner = cache.begin("k", "body-2")
+    assert not owner
+    assert other.fingerprint != "body-2"
+    assert cache.stats()["mismatched"] == 1
+
+
+def test_cache_replace_supersedes_a_different_fingerprint():
+    cache = IdempotencyCache(ttl=60)
+    entry, _ = cache.begin("k", "present", replace=True)
+    cache.complete("k", entry, ("present", 201, "application/json"))
+
+    newer, owner = cache.begin("k", "absent", replace=True)
+    assert owner and newer is not entry
+    assert cache.stats()["superseded"] == 1
+
+
+def test_cache_discard_and_abandon_let_the_next_request_run():
+    cache = IdempotencyCache(ttl=60)
+    entry, _ = cache.begin("k", "x")
+    cache.complete("k", entry, ("ok", 200, "application/json"))
+    cache.discard("k")
+    entry, owner = cache.begin("k", "x")
+    assert owner
+    cache.abandon("k", entry)
+    assert cache.wait(entry, 1) is None
+    assert cache.begin("k", "x")[1]
+
+
+@pytest.fixture(scope="module")
+def main():
+    import main
+    return main
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
+
+
+@pytest.fixture
+def tag(client):
+    user_id, tag_id = f"user-{uuid.uuid4().hex}", f"tag-{uuid.uuid4().hex}"
+    assert client.post("/users", json={"id": user_id, "name": "Test", "email": f"{user_id}@example.com"}).status_code == 201
+    assert client.post("/nfc", json={"tag_id": tag_id, "user_id": user_id}).status_code == 201
+    return tag_id
+
+
+def stored_status(client, tag_id, date):
+    rows = client.get(f"/attendance?tag_id={tag_id}&date={date}").get_json()
+    return rows[0]["status"]
+
+
+def tap(client, tag_id, status, date="2026-01-05", **kwargs):
+    return client.post("/attendance", json={"tag_id": tag_id, "status": status, "date": date}, **kwargs)
+
+
+def test_identical_tap_is_replayed(client, tag):
+    first = tap(client, tag, "present")
+    second = tap(client, tag, "present")
+    assert first.status_code == second.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.get_json() == first.get_json()
+
+
+def test_changed_tap_within_window_is_applied(client, tag):
+    for status in ("present", "absent", "present"):
+        response = tap(client, tag, status)
+        assert response.status_code == 201
+        assert "Idempotent-Replayed" not in response.headers
+        assert response.get_json()["attendance_status"] == status
+    assert stored_status(client, tag, "2026-01-05") == "present"
+
+
+def test_batch_tap_clears_the_debounce_entry(client, tag):
+    assert tap(client, tag, "present").status_code == 201
+    batch = client.post("/attendance/batch", json={"items": [{"tag_id": tag, "status": "absent", "date": "2026-01-05"}]})
+    assert batch.get_json()["applied"] == 1
+
+    response = tap(client, tag, "present")
+    assert "Idempotent-Replayed" not in response.headers
+    assert stored_status(client, tag, "2026-01-05") == "present"
+
+
+def test_non_string_tag_id_is_rejected(client):
+    for tag_id in (["a"], {"a": 1}, 7):
+        response = client.post("/attendance", json={"tag_id": tag_id})
+        assert response.status_code == 400
+
+
+def test_idempotency_key_replays_the_same_body(client, tag):
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    first = tap(client, tag, "present", date="2026-01-06", headers=headers)
+    second = tap(client, tag, "present", date="2026-01-06", headers=headers)
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.get_json() == first.get_json()
+
+
+def test_idempotency_key_rejects_a_different_body(client, tag):
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    assert tap(client, tag, "present", date="2026-01-07", headers=headers).status_code == 201
+    response = tap(client, tag, "absent", date="2026-01-07", headers=headers)
+    assert response.status_code == 422
+    assert stored_status(client, tag, "2026-01-07") == "present"
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+
+import pytest
+
+from db import ConnectionPool, GroupCommitWriter
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "writer.db"))
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE items (name TEXT PRIMARY KEY)")
+        conn.commit()
+    yield pool
+    pool.close_all()
+
+
+def names(pool):
+    with pool.connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT name FROM items"))
+
+
+def insert(conn, name):
+    conn.execute("INSERT INTO items (name) VALUES (?)", (name,))
+    return name
+
+
+def insert_then_fail(conn, name):
+    insert(conn, name)
+    raise ValueError(f"rejected {name}")
+
+
+class FakeLock:
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class GateLock(FakeLock):
+    """A write lock that holds the first group until the test opens the gate."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+
+    def acquire(self):
+        self.gate.wait(5)
+
+
+def test_failing_op_rolls_back_only_itself(pool):
+    lock = GateLock()
+    writer = GroupCommitWriter(pool, max_batch=8, max_delay=0, write_lock=lock, timeout=5)
+    try:
+        futures = [writer.submit(insert, "a"), writer.submit(insert_then_fail, "b"), writer.submit(insert, "c")]
+        lock.gate.set()
+        assert futures[0].result(5) == "a"
+        with pytest.raises(ValueError, match="rejected b"):
+            futures[1].result(5)
+        assert futures[2].result(5) == "c"
+        assert names(pool) == ["a", "c"]
+        stats = writer.stats()
+        assert stats["batches"] == 1
+        assert stats["committed"] == 2
+        assert stats["failed"] == 1
+    finally:
+        writer.stop()
+
+
+class BrokenLock(FakeLock):
+    """A write lock that fails its first ``failures`` acquisitions."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def acquire(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("lock file unavailable")
+
+
+def test_group_failure_fails_every_op_and_writer_recovers(pool):
+    writer = GroupCommitWriter(pool, max_batch=8, max_delay=0.05, write_lock=BrokenLock(1), timeout=5)
+    try:
+        futures = [writer.submit(insert, name) for name in ("a", "b")]
+        for future in futures:
+            with pytest.raises(OSError, match="lock file unavailable"):
+                future.result(5)
+        assert names(pool) == []
+        assert writer.run(insert, "c") == "c"
+        assert names(pool) == ["c"]
+    finally:
+        writer.stop()
+
+
+def test_broken_connection_is_replaced_and_discarded(pool):
+    writer = GroupCommitWriter(pool, timeout=5)
+    try:
+        writer.run(insert, "a")
+        in_use = pool.stats()["in_use"]
+
+        def close_and_fail(conn):
+            conn.close()
+            raise RuntimeError("connection lost")
+
+        with pytest.raises(sqlite3.ProgrammingError):
+            writer.run(close_and_fail)
+        assert writer.run(insert, "b") == "b"
+        assert names(pool) == ["a", "b"]
+        assert pool.stats()["in_use"] == in_use
+    finally:
+        writer.stop()